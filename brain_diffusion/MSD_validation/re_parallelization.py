@@ -10,6 +10,7 @@ import random
 import numpy as np
 import numpy.ma as ma
 import numpy.linalg as la
+from brain_diffusion.trajectory_utils import index_trajectory_files
 
 pi = np.pi
 sin = np.sin
@@ -56,12 +57,16 @@ def fillin2(data):
     return filledin
 
 
-def MSD_iteration(folder, name, cut, totvids, conversion, frames):
+def MSD_iteration(files, cut, conversion, frames):
     """
     Cleans up data for MSD analysis from csv files.  Outputs in form of
-    dictionaries.
+    dictionaries.  files maps video numbers to trajectory filenames, as in the
+    output of index_trajectory_files.
     """
 
+    videos = sorted(files)
+    totvids = len(videos)
+
     trajectory = dict()
     tots = dict()  # Total particles in each video
     newtots = dict()  # Cumulative total particles.
@@ -71,7 +76,7 @@ def MSD_iteration(folder, name, cut, totvids, conversion, frames):
     tlength[0] = 0
 
     for num in range(1, totvids + 1):
-        trajectory[num] = np.genfromtxt(folder+'Traj_{}_{}.tif.csv'.format(name, num), delimiter=",")
+        trajectory[num] = np.genfromtxt(files[videos[num-1]], delimiter=",")
         trajectory[num] = np.delete(trajectory[num], 0, 1)
 
         tots[num] = trajectory[num][-1, 0].astype(np.int64)
@@ -196,6 +201,9 @@ cut = 1
 totvids = 9
 frame_m = 401  # atm I can't go lower than the actual value.
 
+# A single directory scan finds the trajectory files of every sample.
+index = index_trajectory_files(folder)
+
 parameters = {}
 parameters["channels"] = ["RED"]
 parameters["surface functionalities"] = ["nPEG"]
@@ -230,7 +238,8 @@ for channel in channels:
                     sample_name = "{}_{}_{}_{}_{}".format(channel, surface_functionality, '37C_72pH', slic, video)
                     DIR = folder
 
-                    total1, xs, ys, x, y = MSD_iteration(DIR, sample_name, cut, totvids, conversion, frame_m)
+                    files = dict((num, index[sample_name][num]) for num in range(1, totvids + 1))
+                    total1, xs, ys, x, y = MSD_iteration(files, cut, conversion, frame_m)
 
                     geoM2xy[sample_name], gSEM[sample_name], SM1x[sample_name], SM1y[sample_name],\
                         SM2xy[sample_name] = vectorized_MMSD_calcs(frames, total1, xs, ys, x, y, frame_m)
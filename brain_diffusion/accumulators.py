@@ -0,0 +1,410 @@
+import numpy as np
+
+
+class EnsembleMSD(object):
+    """
+    Ensemble-averaged and time-and-ensemble-averaged MSDs, accumulated from
+    running sums while vectorized_MMSD_calcs processes chunks of particles.
+
+    Pass instances to vectorized_MMSD_calcs with accumulators=[...].  They
+    are reset at the start of the calculation and hold the results once it
+    returns, so SM2xy never has to be kept to get a population curve.
+
+    Attributes
+    ----------
+    lags : numpy array of integers
+        Lags, in frames, of each entry of the results.
+    ensemble_msd : numpy array
+        Ensemble-averaged 2D MSD at each lag, i.e. the mean over particles of
+        the squared displacement from the first frame of each trajectory.
+    ensemble_counts : numpy array of integers
+        Number of particles found both in their first frame and lag frames
+        later.
+    time_ensemble_msd : numpy array
+        Time-and-ensemble-averaged 2D MSD at each lag, i.e. the mean squared
+        displacement over all pairs of frames of all particles.
+    time_ensemble_counts : numpy array of integers
+        Number of displacements averaged at each lag.
+
+    Examples
+    --------
+    >>> ensemble = EnsembleMSD()
+    >>> outputs = vectorized_MMSD_calcs(frames, total1, xs_m, ys_m, accumulators=[ensemble])
+    >>> ensemble.time_ensemble_msd
+
+    """
+
+    def __init__(self):
+        self.reset(np.zeros(0, dtype=np.int64), 2)
+
+    def reset(self, lags, ndim):
+        """
+        Clears the running sums for a new calculation at lags of ndim
+        dimensional coordinates.
+        """
+
+        self.lags = np.asarray(lags, dtype=np.int64)
+        shape = (ndim, self.lags.shape[0])
+        self._ensemble_sums = np.zeros(shape)
+        self._ensemble_pairs = np.zeros(shape, dtype=np.int64)
+        self._time_sums = np.zeros(shape)
+        self._time_pairs = np.zeros(shape, dtype=np.int64)
+
+    # Whether update_lag needs the displacements at each lag.
+    displacements = False
+
+    def update(self, values, found):
+        """
+        Adds a chunk of particles, before its lags are processed.
+
+        Parameters
+        ----------
+        values : numpy array
+            Coordinates of the chunk, of dimensions frames x particles x ndim,
+            with trajectories shifted to begin at frame 0 and missing
+            positions set to 0.
+        found : numpy array of booleans
+            True where a position was found, broadcastable to values.
+
+        """
+
+        for row, lag in enumerate(self.lags):
+            both = np.broadcast_to(found[lag] & found[0], values.shape[1:])
+            steps = np.where(both, values[lag] - values[0], 0)
+            self._ensemble_sums[:, row] += np.einsum('jk,jk->k', steps, steps)
+            self._ensemble_pairs[:, row] += np.count_nonzero(both, axis=0)
+
+    def update_lag(self, row, totals, pairs, steps=None, both=None):
+        """
+        Adds the displacements of the chunk at lag self.lags[row].
+
+        Parameters
+        ----------
+        row : integer
+            Index of the lag in self.lags.
+        totals : numpy array
+            Sums of squared displacements of each particle along each axis,
+            of dimensions particles x ndim.
+        pairs : numpy array of integers
+            Number of displacements in totals, broadcastable to totals.
+        steps : numpy array or None
+            Displacements at the lag, of dimensions
+            (frames - lag) x particles x ndim, set to 0 where both is False.
+            Only given if self.displacements is True or with
+            algorithm='direct', and None at lag 0.
+        both : numpy array of booleans or None
+            True where both positions of a displacement were found,
+            broadcastable to steps.
+
+        """
+
+        self._time_sums[:, row] += np.sum(totals, axis=0)
+        self._time_pairs[:, row] += np.sum(np.broadcast_to(pairs, totals.shape), axis=0)
+
+    def merge(self, other):
+        """
+        Adds the running sums of other, which covers other particles at the
+        same lags.
+        """
+
+        assert np.array_equal(self.lags, other.lags), "Only accumulators of the same lags can be merged"
+        self._ensemble_sums += other._ensemble_sums
+        self._ensemble_pairs += other._ensemble_pairs
+        self._time_sums += other._time_sums
+        self._time_pairs += other._time_pairs
+
+    @property
+    def ensemble_msd(self):
+        return _mean_msd(self._ensemble_sums, self._ensemble_pairs)
+
+    @property
+    def ensemble_counts(self):
+        return np.min(self._ensemble_pairs, axis=0)
+
+    @property
+    def time_ensemble_msd(self):
+        return _mean_msd(self._time_sums, self._time_pairs)
+
+    @property
+    def time_ensemble_counts(self):
+        return np.min(self._time_pairs, axis=0)
+
+
+class VanHove(object):
+    """
+    Histograms of the displacements of all particles at each lag (the self
+    part of the van Hove correlation function), binned while
+    vectorized_MMSD_calcs processes chunks of particles, so that no
+    displacement is stored.
+
+    Pass instances to vectorized_MMSD_calcs with accumulators=[...].  The
+    displacements at each lag are those vectorized_MMSD_calcs takes with
+    algorithm='direct', so nothing is computed twice.  With algorithm='fft'
+    they are formed from each chunk only for the accumulators.
+
+    Parameters
+    ----------
+    edges : numpy array
+        Bin edges of the histograms.  With adaptive=True these are the edges
+        at a lag of 1 frame.
+    adaptive : boolean
+        If True, the edges at a lag of tau frames are edges*sqrt(tau), so
+        that the bins follow the spread of diffusive displacements and the
+        histograms of all lags have the same resolution.
+    radial : boolean
+        If True, histograms the length of the displacement vectors.
+        Otherwise the displacements along each axis are pooled, which is
+        Gaussian for normal diffusion.
+
+    Attributes
+    ----------
+    lags : numpy array of integers
+        Lags, in frames, of each histogram.
+    edges : numpy array
+        Bin edges at each lag, of dimensions lags x (bins + 1).
+    counts : numpy array of integers
+        Number of displacements in each bin at each lag, of dimensions
+        lags x bins.  Histograms at lag 0 are left empty.
+    outside : numpy array of integers
+        Number of displacements at each lag that fell outside the edges.
+
+    Examples
+    --------
+    >>> vanhove = VanHove(np.linspace(-2, 2, 41), adaptive=True)
+    >>> outputs = vectorized_MMSD_calcs(frames, total1, xs_m, ys_m, accumulators=[vanhove])
+    >>> vanhove.density[10]
+
+    """
+
+    def __init__(self, edges, adaptive=False, radial=False):
+        edges = np.asarray(edges, dtype=np.float64)
+        assert edges.ndim == 1 and edges.shape[0] > 1, "edges must contain at least 2 bin edges"
+        assert np.all(np.diff(edges) > 0), "edges must be increasing"
+        self.base_edges = edges
+        self.adaptive = adaptive
+        self.radial = radial
+        self.reset(np.zeros(0, dtype=np.int64), 2)
+
+    def reset(self, lags, ndim):
+        """
+        Clears the histograms for a new calculation at lags of ndim
+        dimensional coordinates.
+        """
+
+        self.lags = np.asarray(lags, dtype=np.int64)
+        scale = np.sqrt(self.lags) if self.adaptive else np.ones(self.lags.shape[0])
+        self.edges = scale[:, np.newaxis] * self.base_edges
+        self.counts = np.zeros((self.lags.shape[0], self.base_edges.shape[0] - 1), dtype=np.int64)
+        self.outside = np.zeros(self.lags.shape[0], dtype=np.int64)
+
+    displacements = True
+
+    def update(self, values, found):
+        """
+        Adds a chunk of particles, whose displacements are binned by
+        update_lag.
+        """
+
+    def update_lag(self, row, totals, pairs, steps=None, both=None):
+        """
+        Bins the displacements of the chunk at lag self.lags[row], see
+        EnsembleMSD.update_lag.
+        """
+
+        if steps is None:
+            return
+        both = np.broadcast_to(both, steps.shape)
+        if self.radial:
+            displacements = np.sqrt(np.einsum('ijk,ijk->ij', steps, steps))[np.all(both, axis=2)]
+        else:
+            displacements = steps[both]
+
+        n_bins = self.counts.shape[1]
+        index = np.searchsorted(self.edges[row], displacements, side='right') - 1
+        # Displacements equal to the last edge go in the last bin, as in np.histogram.
+        index[displacements == self.edges[row, -1]] = n_bins - 1
+        inside = (index >= 0) & (index < n_bins)
+        self.counts[row] += np.bincount(index[inside], minlength=n_bins)
+        self.outside[row] += np.count_nonzero(~inside)
+
+    def merge(self, other):
+        """
+        Adds the histograms of other, which covers other particles at the
+        same lags.
+        """
+
+        assert np.array_equal(self.lags, other.lags), "Only accumulators of the same lags can be merged"
+        self.counts += other.counts
+        self.outside += other.outside
+
+    @property
+    def density(self):
+        """
+        Probability density of the displacements at each lag, normalized by
+        all displacements at that lag including those outside the edges.
+        """
+
+        total = np.sum(self.counts, axis=1) + self.outside
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(total[:, np.newaxis] > 0,
+                            self.counts / (np.maximum(total, 1)[:, np.newaxis] * np.diff(self.edges, axis=1)), 0)
+
+
+class NonGaussian(object):
+    """
+    Second and fourth moments of the displacements at each lag, and the
+    non-Gaussian parameter
+
+    alpha2 = ndim*<dr**4>/((ndim + 2)*<dr**2>**2) - 1,
+
+    i.e. <dr**4>/(2*<dr**2>**2) - 1 in 2D, which is 0 for Gaussian
+    displacements and grows with heterogeneous transport.  Moments are summed
+    from the displacements vectorized_MMSD_calcs takes at each lag, using
+    only those for which every axis was found.  With algorithm='fft' the
+    displacements are formed from each chunk only for the accumulators.
+
+    Parameters
+    ----------
+    per_track : boolean
+        If True, moments are also kept for each trajectory.
+
+    Attributes
+    ----------
+    lags : numpy array of integers
+        Lags, in frames, of each entry of the results.
+    second_moment, fourth_moment : numpy arrays
+        <dr**2> and <dr**4> over all displacements at each lag.
+    counts : numpy array of integers
+        Number of displacements at each lag.
+    alpha2 : numpy array
+        Non-Gaussian parameter of all displacements at each lag, nan where
+        there are no displacements.
+    track_second_moment, track_fourth_moment, track_counts, track_alpha2 : numpy arrays
+        The same for each trajectory if per_track is True, of dimensions
+        lags x particles in the order of the columns of the input.
+
+    Examples
+    --------
+    >>> nongaussian = NonGaussian(per_track=True)
+    >>> outputs = vectorized_MMSD_calcs(frames, total1, xs_m, ys_m, accumulators=[nongaussian])
+    >>> nongaussian.alpha2
+
+    """
+
+    def __init__(self, per_track=False):
+        self.per_track = per_track
+        self.reset(np.zeros(0, dtype=np.int64), 2)
+
+    def reset(self, lags, ndim):
+        """
+        Clears the sums for a new calculation at lags of ndim dimensional
+        coordinates.
+        """
+
+        self.lags = np.asarray(lags, dtype=np.int64)
+        self.ndim = ndim
+        self._sums = np.zeros((3, self.lags.shape[0]))
+        # Sums of each chunk of particles, concatenated in particle order.
+        self._track_sums = []
+
+    displacements = True
+
+    def update(self, values, found):
+        """
+        Adds a chunk of particles, whose displacements are summed by
+        update_lag.
+        """
+
+        if self.per_track:
+            self._track_sums.append(np.zeros((3, self.lags.shape[0], values.shape[1])))
+
+    def update_lag(self, row, totals, pairs, steps=None, both=None):
+        """
+        Adds the displacements of the chunk at lag self.lags[row], see
+        EnsembleMSD.update_lag.
+        """
+
+        if steps is None:
+            return
+        squares = steps[:, :, 0]**2
+        for dim in range(1, steps.shape[2]):
+            squares += steps[:, :, dim]**2
+        if both.shape[2] == 1:
+            # Axes share their mask, so steps is already 0 where any is missing.
+            counts = np.broadcast_to(pairs, totals.shape)[:, 0]
+        else:
+            joint = both[:, :, 0].copy()
+            for dim in range(1, both.shape[2]):
+                joint &= both[:, :, dim]
+            squares *= joint
+            counts = np.count_nonzero(joint, axis=0)
+        sums = np.array([counts, np.sum(squares, axis=0), np.einsum('ij,ij->j', squares, squares)])
+
+        self._sums[:, row] += np.sum(sums, axis=1)
+        if self.per_track:
+            self._track_sums[-1][:, row] = sums
+
+    def merge(self, other):
+        """
+        Adds the sums of other, which covers the particles following those of
+        self at the same lags.
+        """
+
+        assert np.array_equal(self.lags, other.lags), "Only accumulators of the same lags can be merged"
+        self._sums += other._sums
+        self._track_sums.extend(other._track_sums)
+
+    def _moments(self, sums):
+        count = sums[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            second = np.where(count > 0, sums[1] / count, np.nan)
+            fourth = np.where(count > 0, sums[2] / count, np.nan)
+            alpha2 = self.ndim*fourth / ((self.ndim + 2)*second**2) - 1
+        return count.astype(np.int64), second, fourth, alpha2
+
+    @property
+    def counts(self):
+        return self._moments(self._sums)[0]
+
+    @property
+    def second_moment(self):
+        return self._moments(self._sums)[1]
+
+    @property
+    def fourth_moment(self):
+        return self._moments(self._sums)[2]
+
+    @property
+    def alpha2(self):
+        return self._moments(self._sums)[3]
+
+    def _track_moments(self):
+        assert self.per_track, "Moments of each trajectory are only kept with per_track=True"
+        if len(self._track_sums) == 0:
+            return self._moments(np.zeros((3, self.lags.shape[0], 0)))
+        return self._moments(np.concatenate(self._track_sums, axis=2))
+
+    @property
+    def track_counts(self):
+        return self._track_moments()[0]
+
+    @property
+    def track_second_moment(self):
+        return self._track_moments()[1]
+
+    @property
+    def track_fourth_moment(self):
+        return self._track_moments()[2]
+
+    @property
+    def track_alpha2(self):
+        return self._track_moments()[3]
+
+
+def _mean_msd(sums, pairs):
+    """
+    Sums the mean squared displacement along each dimension, with 0 where no
+    displacement is available.
+    """
+
+    return np.sum(np.where(pairs > 0, sums / np.maximum(pairs, 1), 0), axis=0)
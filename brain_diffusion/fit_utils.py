@@ -0,0 +1,109 @@
+import numpy as np
+import numpy.ma as ma
+
+
+def fit_power_law(SM2xy, lags=None, fps=100.02, lag_window=(1, None), weights=None, ndim=2):
+    """
+    Fits MSD = 2*ndim*D*t**alpha to the MSDs of every trajectory at once, by
+    weighted least squares on log MSD against log t.
+
+    Parameters
+    ----------
+    SM2xy : numpy array of dimensions lags x particles
+        MSDs of each trajectory, e.g. output from vectorized_MMSD_calcs.
+        Can be a masked array.  Masked, NaN, zero and negative entries are
+        left out of the fit.
+    lags : list of integers or None
+        Lag, in frames, of each row of SM2xy.  By default row i is lag i, as
+        in the outputs of vectorized_MMSD_calcs without lags.
+    fps : float or int
+        The frame rate of the video being analyzed, used to convert lags to
+        times.
+    lag_window : tuple of integers
+        Smallest and largest lag, in frames, included in the fit.  Either can
+        be None for no bound.
+    weights : numpy array or None
+        Weight of each point in the fit, either one per row of SM2xy (such as
+        the number of displacements averaged at each lag) or of the same
+        dimensions as SM2xy.  By default all points have the same weight.
+    ndim : integer
+        Number of dimensions of the MSDs, 4*D*t being the 2D MSD of normal
+        diffusion.
+
+    Returns
+    -------
+    D : numpy array of floats
+        Diffusion coefficient of each trajectory, in units of SM2xy per second
+        to the power alpha.
+    alpha : numpy array of floats
+        Anomalous exponent of each trajectory.
+    r2 : numpy array of floats
+        Coefficient of determination of each fit in log space.
+    n : numpy array of integers
+        Number of points in each fit.  D, alpha and r2 are nan where there
+        are fewer than two points at distinct lags.
+
+    Examples
+    --------
+    >>> t = np.arange(30)/100.02
+    >>> SM2xy = 4*0.5*t[:, np.newaxis]**np.array([0.8, 1.0, 1.2])
+    >>> D, alpha, r2, n = fit_power_law(SM2xy, lag_window=(1, 20))
+    >>> alpha
+    array([ 0.8,  1. ,  1.2])
+
+    """
+
+    assert isinstance(SM2xy, np.ndarray), "SM2xy must be a numpy array"
+    assert SM2xy.ndim == 2, "SM2xy must be of dimensions lags x particles"
+    assert len(lag_window) == 2, "lag_window must contain 2 elements"
+    assert type(ndim) is int and ndim > 0, "ndim must be a positive integer"
+
+    if lags is None:
+        lags = np.arange(SM2xy.shape[0])
+    lags = np.asarray(lags)
+    assert lags.shape == (SM2xy.shape[0],), "lags must have one entry per row of SM2xy"
+
+    # Rows outside the window are dropped before anything else is computed.
+    low, high = lag_window
+    rows = lags > 0
+    if low is not None:
+        rows &= lags >= low
+    if high is not None:
+        rows &= lags <= high
+
+    values = ma.filled(ma.asarray(SM2xy)[rows, :].astype(np.float64), np.nan)
+    valid = np.isfinite(values) & (values > 0)
+    logs = np.log(np.where(valid, values, 1))
+    times = np.log(lags[rows] / fps)[:, np.newaxis]
+
+    if weights is None:
+        w = valid.astype(np.float64)
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+        if weights.ndim == 1:
+            assert weights.shape == (SM2xy.shape[0],), "weights must have one entry per row of SM2xy"
+            weights = weights[:, np.newaxis]
+        w = np.where(valid, weights[rows], 0)
+
+    n = np.count_nonzero(valid & (w > 0), axis=0)
+    W = np.sum(w, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Centering on the weighted means keeps the sums well conditioned.
+        mean_t = np.sum(w*times, axis=0) / W
+        mean_log = np.sum(w*logs, axis=0) / W
+        dt = times - mean_t
+        dlog = np.where(valid, logs - mean_log, 0)
+        Stt = np.sum(w*dt**2, axis=0)
+        Stl = np.sum(w*dt*dlog, axis=0)
+        Sll = np.sum(w*dlog**2, axis=0)
+
+        alpha = Stl / Stt
+        D = np.exp(mean_log - alpha*mean_t) / (2*ndim)
+        r2 = np.where(Sll > 0, Stl**2 / (Stt*Sll), 1.0)
+
+    fitted = (n >= 2) & (Stt > 0)
+    D = np.where(fitted, D, np.nan)
+    alpha = np.where(fitted, alpha, np.nan)
+    r2 = np.where(fitted, r2, np.nan)
+
+    return D, alpha, r2, n
@@ -1,3 +1,5 @@
+import os
+import sys
 import numpy as np
 import numpy.ma as ma
 import scipy.stats as stat
@@ -6,14 +8,30 @@ import matplotlib as mpl
 import matplotlib.pyplot as plt
 import scipy.stats as stat
 from histogram_utils import histogram_by_video
+from brain_diffusion.trajectory_utils import index_trajectory_files
+
+# The extension is part of the name, so that the .csv and .npy files of a
+# sample are both indexed.
+SM_PATTERN = '^SM2xy_(?P<name>.+[.](csv|npy))$'
 
 def main():
     """
     Function that allows the user to graph histograms of all files in a folder
-    from the command line.
+    from the command line.  Arguments can be MSD files or folders, in which
+    case the SM2xy_{name}.npy file, or else the SM2xy_{name}.csv file, of
+    every sample in the folder is graphed.
     """
     script = sys.argv[0]
-    for filename in sys.argv[1:]:
-        histogram_by_video(filename)
+    for argument in sys.argv[1:]:
+        if os.path.isdir(argument):
+            index = index_trajectory_files(argument, pattern=SM_PATTERN)
+            samples = dict()
+            # .csv sorts before .npy, so the .npy file of a sample with both is kept.
+            for name in sorted(index):
+                samples[os.path.splitext(name)[0]] = index[name][None]
+            for name in sorted(samples):
+                histogram_by_video(samples[name])
+        else:
+            histogram_by_video(argument)
 
 main()
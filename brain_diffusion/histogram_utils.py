@@ -2,9 +2,11 @@ import numpy as np
 import numpy.ma as ma
 import scipy.stats as stat
 import random
+import os
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import scipy.stats as stat
+from brain_diffusion.trajectory_utils import csv_to_array
 
 
 def histogram_by_video(SMfilename, xlabel='Log Diffusion Coefficient Dist', ylabel='Trajectory Count', fps=100.02,
@@ -15,8 +17,9 @@ def histogram_by_video(SMfilename, xlabel='Log Diffusion Coefficient Dist', ylab
     Parameters
     ----------
     SMfilename : string
-        Filename of particle MSDs.  Must be a csv file, comma delimited. Must be
-        organized as frames x particles.
+        Filename of particle MSDs.  Must be a csv file, comma delimited, or a
+        .npy file such as the memory-mapped output of vectorized_MMSD_calcs.
+        Must be organized as frames x particles.
     xlabel : string
         X label of the output graph.
     ylabel : string
@@ -53,9 +56,8 @@ def histogram_by_video(SMfilename, xlabel='Log Diffusion Coefficient Dist', ylab
     """
 
     assert type(SMfilename) is str, "SMfilename must be a string"
-    assert SMfilename.split('.')[1] == 'csv', "SMfilename must be a csv file."
-    # assert os.path.isfile(SMfilename), "SMfilename must exist."
-    assert type(np.genfromtxt(SMfilename, delimiter=",")) == np.ndarray, "SMfilename must be comma delimited."
+    assert os.path.splitext(SMfilename)[1] in ('.csv', '.npy'), "SMfilename must be a csv or npy file."
+    assert os.path.isfile(SMfilename), "SMfilename must exist."
     assert type(xlabel) is str, "xlabel must be a string"
     assert type(ylabel) is str, "ylabel must be a string"
     assert type(fps) is float or int, "fps must be float or int"
@@ -65,7 +67,10 @@ def histogram_by_video(SMfilename, xlabel='Log Diffusion Coefficient Dist', ylab
     assert type(theta) is str, "theta must be string"
 
     # load data
-    SM2xy = np.genfromtxt(SMfilename, delimiter=",")
+    if os.path.splitext(SMfilename)[1] == '.npy':
+        SM2xy = np.load(SMfilename, mmap_mode='r')
+    else:
+        SM2xy = csv_to_array(SMfilename)
 
     # generate keys for legend
     bar = {}
@@ -121,5 +126,5 @@ def histogram_by_video(SMfilename, xlabel='Log Diffusion Coefficient Dist', ylab
             plt.gca().set_xlim([0, x_range])
 
         plt.legend(fontsize=20, frameon=False)
-    plt.savefig(SMfilename.split('.csv')[0]+'_hist.png', bbox_inches='tight')
+    plt.savefig(os.path.splitext(SMfilename)[0]+'_hist.png', bbox_inches='tight')
     return 'Graph completed successfully'
@@ -11,6 +11,7 @@ import numpy as np
 import numpy.ma as ma
 import numpy.linalg as la
 from msd import fillin2, MSD_iteration, vectorized_MMSD_calcs
+from brain_diffusion.trajectory_utils import index_trajectory_files, TrajectorySet
 
 
 comm = MPI.COMM_WORLD
@@ -21,6 +22,9 @@ folder = "./"
 path = "./geoM2xy_{sample_name}.csv"
 conversion = (0.16, 20.08, 1)  # (0.3, 3.95, 1)
 cut = 1
+dtype = np.float64  # np.float32 halves memory use and output size.
+fmt = '%.9g' if dtype == np.float32 else '%.18e'
+n_jobs = 1  # Worker processes per rank for the MSD calculation, e.g. cores per node / ranks per node.
 base = '37C_72pH'
 
 parameters = {}
@@ -43,6 +47,9 @@ SM1y = {}
 SM2xy = {}
 totvids = len(replicates)
 
+# A single directory scan finds the trajectory files of every sample.
+index = index_trajectory_files(folder)
+
 ################################################################################
 check_rank = 1
 
@@ -55,13 +62,16 @@ for channel in channels:
                     sample_name = "{}_{}_{}_{}_{}".format(channel, surface_functionality, base, slic, video)
                     DIR = folder
 
-                    total1, frames, xs, ys, x, y = MSD_iteration(DIR, sample_name, cut=cut, totvids=totvids, conversion=conversion)
+                    trajset = TrajectorySet(DIR, sample_name, videos=replicates, index=index)
+                    total1, frames, xs, ys, x, y = MSD_iteration(trajset, cut=cut, conversion=conversion,
+                                                                  dtype=dtype)
 
                     geoM2xy[sample_name], gSEM[sample_name], SM1x[sample_name], SM1y[sample_name],\
-                        SM2xy[sample_name] = vectorized_MMSD_calcs(frames, total1, xs, ys)
+                        SM2xy[sample_name] = vectorized_MMSD_calcs(frames, total1, xs, ys, n_jobs=n_jobs, dtype=dtype,
+                                                                   outputs=('SM2xy',))
                     np.savetxt(DIR+'geoM2xy_{}.csv'.format(sample_name), geoM2xy[sample_name], delimiter=',')
                     np.savetxt(DIR+'gSEM_{}.csv'.format(sample_name), gSEM[sample_name], delimiter=',')
-                    np.savetxt(DIR+'SM2xy_{}.csv'.format(sample_name), SM2xy[sample_name], delimiter=',')
+                    np.savetxt(DIR+'SM2xy_{}.csv'.format(sample_name), SM2xy[sample_name], delimiter=',', fmt=fmt)
 
                     slice_counter = slice_counter + 1
                 check_rank = check_rank + 1
@@ -1,18 +1,42 @@
 import os
+import copy
 import csv
 import sys
 import scipy.optimize as opt
+import scipy.fft as sfft
 import scipy.stats as stat
 from operator import itemgetter
 import random
 import numpy as np
 import numpy.ma as ma
 import numpy.linalg as la
+from concurrent import futures
+from multiprocessing import shared_memory
+from brain_diffusion.trajectory_utils import (read_trajectory, trajectory_file_info, group_tracks, RaggedTrajectories,
+                                              TrajectorySet, index_trajectory_files, validate_trajectories,
+                                              trajectory_cache_dir, prune_trajectory_cache, TRAJ_PATTERN)
 
 
-def fillin2(data):
+def _fillin_index(frames):
     """
-    fillin2(data)
+    Returns the row of a track that the fillin2 loop carries into each frame
+    from the first to the last frame of the track.  Frames must be strictly
+    increasing.
+    """
+
+    index = np.searchsorted(frames, np.arange(frames[0], frames[-1] + 1), side='right') - 1
+
+    # The loop lags one row behind within the initial run of consecutive frames.
+    breaks = np.flatnonzero(np.diff(frames) != 1)
+    run = breaks[0] + 1 if breaks.shape[0] > 0 else frames.shape[0]
+    index[1:run] = index[1:run] - 1
+
+    return index
+
+
+def fillin2(data, check=True, method='index'):
+    """
+    fillin2(data, check=True, method='index')
 
     Fills in blanks in an input trajectory dataset.
 
@@ -22,6 +46,14 @@ def fillin2(data):
         Must have 5 columns containing in order Track ID, frames, x coordinates,
         y coordinates, and z coordinates.  Must contain a single Track ID, no
         more.  Frames must be in ascending order.
+    check : boolean
+        If True, the input is checked before filling in.  MSD_iteration
+        validates all tracks at once and skips the per-track checks.
+    method : string
+        'index' builds the carry-forward index of every frame at once with
+        np.searchsorted.  'loop' is the original frame by frame loop, kept as
+        a reference.  Both give the same output; tracks with repeated frames
+        always use the loop.
 
     Returns
     -------
@@ -54,10 +86,21 @@ def fillin2(data):
 
     """
 
-    assert data.shape[1] == 5, "Input array must have five columns."
-    assert type(data) == np.ndarray, "Input must be a numpy array"
-    assert np.all(np.diff(data[:, 1]) == abs(np.diff(data[:, 1]))), "Frames must all increase."
-    assert data.shape[0] > 0, "Array must not be empty."
+    if check:
+        assert data.shape[1] == 5, "Input array must have five columns."
+        assert type(data) == np.ndarray, "Input must be a numpy array"
+        assert np.all(np.diff(data[:, 1]) == abs(np.diff(data[:, 1]))), "Frames must all increase."
+        assert data.shape[0] > 0, "Array must not be empty."
+    assert method in ('index', 'loop'), "method must be 'index' or 'loop'"
+
+    frames = data[:, 1]
+    if method == 'index' and np.all(frames[1:] > frames[:-1]):
+        index = _fillin_index(frames)
+        filledin = np.empty((index.shape[0], 5))
+        filledin[:, 0] = data[index, 0]
+        filledin[:, 1] = np.linspace(frames[0], frames[-1], index.shape[0])
+        filledin[:, 2:5] = data[index, 2:5]
+        return filledin
 
     shap = int(max(data[:, 1])) + 1
     shape1 = int(min(data[:, 1]))
@@ -88,23 +131,436 @@ def fillin2(data):
     return filledin
 
 
-def MSD_iteration(folder, name, cut=1, totvids=1, conversion=(1, 1, 1)):
+def _segment_rows(starts, counts):
+    """
+    Returns the concatenation of range(start, start + count) for each segment.
+    """
+
+    offsets = np.cumsum(counts) - counts
+    return np.arange(np.sum(counts)) - np.repeat(offsets - starts, counts)
+
+
+# Ways of handling frames in which a particle wasn't found, see fillin_tracks.
+GAP_STRATEGIES = ('carry', 'linear', 'missing')
+
+
+def gap_statistics(data, starts, counts):
+    """
+    Counts the gaps in many trajectories at once.
+
+    Parameters
+    ----------
+    data : numpy array
+        Trajectory dataset with 5 columns containing in order Track ID,
+        frames, x coordinates, y coordinates, and z coordinates, with the rows
+        of each track adjacent and in ascending frame order.
+    starts : numpy array of integers
+        Index of the first row of each track.
+    counts : numpy array of integers
+        Number of rows of each track.
+
+    Returns
+    -------
+    n_gaps : numpy array of integers
+        Number of gaps, i.e. runs of missing frames, in each track.
+    longest_gap : numpy array of integers
+        Number of frames in the longest gap of each track.
+
+    """
+
+    starts = np.asarray(starts, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    n_gaps = np.zeros(starts.shape[0], dtype=np.int64)
+    longest_gap = np.zeros(starts.shape[0], dtype=np.int64)
+    if starts.shape[0] == 0:
+        return n_gaps, longest_gap
+
+    rows = _segment_rows(starts, counts)
+    in_offsets = np.cumsum(counts) - counts
+    same_track = np.ones(rows.shape[0] - 1, dtype=bool)
+    same_track[in_offsets[1:] - 1] = False
+    missing = np.maximum(np.diff(data[rows, 1])[same_track].astype(np.int64) - 1, 0)
+
+    track = np.repeat(np.arange(starts.shape[0]), counts - 1)
+    n_gaps = np.bincount(track, weights=missing > 0, minlength=starts.shape[0]).astype(np.int64)
+    np.maximum.at(longest_gap, track, missing)
+
+    return n_gaps, longest_gap
+
+
+def fillin_tracks(data, starts, counts, n_frames=None, gap_strategy='carry', ndim=2):
+    """
+    Fills in blanks in many trajectories at once.
+
+    With gap_strategy='carry', gives the same result as calling fillin2 on
+    every track, without slicing the dataset track by track.  The rows of all
+    tracks are located with a single np.searchsorted over a key that is
+    increasing across the whole dataset.
+
+    Parameters
+    ----------
+    data : numpy array
+        Trajectory dataset with 5 columns containing in order Track ID,
+        frames, x coordinates, y coordinates, and z coordinates, with the rows
+        of each track adjacent and in ascending frame order.
+    starts : numpy array of integers
+        Index of the first row of each track to be filled in.
+    counts : numpy array of integers
+        Number of rows of each track.
+    n_frames : integer or None
+        Number of frames of the dense view of the output, see
+        trajectory_utils.RaggedTrajectories.
+    gap_strategy : string
+        How frames in which a particle wasn't found are handled.  'carry'
+        carries the last position forward as fillin2 does, which makes
+        displacements across a gap zero.  'linear' interpolates linearly
+        between the positions before and after the gap.  'missing' leaves
+        gaps out, so that they take the fill value of the dense view and are
+        excluded from MSDs.
+    ndim : integer
+        2 to keep x and y coordinates, 3 to keep z as well.
+
+    Returns
+    -------
+    traj : trajectory_utils.RaggedTrajectories
+        Filled in x and y (and z if ndim is 3) coordinates of every track,
+        with the Track IDs of data, and the output of gap_statistics for each
+        track in traj.n_gaps and traj.longest_gap.
+
+    Examples
+    --------
+    >>> order, ids, starts, counts = group_tracks(data[:, 0])
+    >>> traj = fillin_tracks(data[order], starts, counts, gap_strategy='linear')
+
+    """
+
+    assert gap_strategy in GAP_STRATEGIES, "gap_strategy must be one of {}".format(GAP_STRATEGIES)
+    assert ndim in (2, 3), "ndim must be 2 or 3"
+
+    axes = slice(2, 2 + ndim)
+    starts = np.asarray(starts, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    track_ids = data[starts, 0].astype(np.int64)
+    n_gaps, longest_gap = gap_statistics(data, starts, counts)
+    if starts.shape[0] == 0:
+        return RaggedTrajectories(np.zeros(0), np.zeros((0, ndim)), np.zeros(1, dtype=np.int64),
+                                  track_ids=track_ids, n_frames=n_frames, n_gaps=n_gaps, longest_gap=longest_gap)
+
+    rows = _segment_rows(starts, counts)
+    frames = data[rows, 1].astype(np.int64)
+    in_offsets = np.cumsum(counts) - counts
+    same_track = np.ones(rows.shape[0] - 1, dtype=bool)
+    same_track[in_offsets[1:] - 1] = False
+    steps = np.diff(frames)
+
+    if np.any(steps[same_track] <= 0):
+        # Repeated frames need the fillin2 loop.
+        assert gap_strategy == 'carry', "Frames must increase within each track."
+        filled = [fillin2(data[start:start+count, 0:5], check=False) for start, count in zip(starts, counts)]
+        traj = RaggedTrajectories.from_tracks([track[:, 1] for track in filled], [track[:, axes] for track in filled],
+                                              track_ids=track_ids, n_frames=n_frames, n_gaps=n_gaps,
+                                              longest_gap=longest_gap)
+    elif gap_strategy == 'missing':
+        traj = RaggedTrajectories(frames, data[rows, axes], np.append(in_offsets, rows.shape[0]),
+                                  track_ids=track_ids, n_frames=n_frames, n_gaps=n_gaps, longest_gap=longest_gap)
+    else:
+        first = frames[in_offsets]
+        lengths = frames[in_offsets + counts - 1] - first + 1
+        out_offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(np.sum(lengths))
+
+        # Key of each row: its output position, increasing across all tracks.
+        keys = frames - np.repeat(first - out_offsets, counts)
+        index = np.searchsorted(keys, positions, side='right') - 1
+
+        if gap_strategy == 'linear':
+            following = np.minimum(index + 1, rows.shape[0] - 1)
+            span = np.maximum(keys[following] - keys[index], 1)
+            weight = np.where(keys[index] == positions, 0, (positions - keys[index]) / span)[:, np.newaxis]
+            coords = (1 - weight)*data[rows[index], axes] + weight*data[rows[following], axes]
+        else:
+            # Length of the initial run of consecutive frames of each track,
+            # inside which fillin2 lags one row behind.
+            breaks = np.flatnonzero(np.append(~same_track | (steps != 1), True))
+            run = np.minimum(breaks[np.searchsorted(breaks, in_offsets)] + 1 - in_offsets, counts)
+            relative = positions - np.repeat(out_offsets, lengths)
+            index = index - ((relative >= 1) & (relative < np.repeat(run, lengths)))
+            coords = data[rows[index], axes]
+
+        traj = RaggedTrajectories(positions - np.repeat(out_offsets - first, lengths), coords,
+                                  np.append(out_offsets, np.sum(lengths)), track_ids=track_ids, n_frames=n_frames,
+                                  n_gaps=n_gaps, longest_gap=longest_gap)
+
+    return traj
+
+
+def _read_video_into(filename, shm_name, shape, start, stop, offset, cache, cache_dir=None):
+    """
+    Reads one trajectory file into its rows of an array in shared memory.
+    """
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        placeholder = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        _copy_video(read_trajectory(filename, cache=cache, cache_dir=cache_dir), placeholder, start, stop, offset)
+        del placeholder
+    finally:
+        shm.close()
+
+
+def _copy_video(data, placeholder, start, stop, offset, conversion=(1, 1, 1)):
+    """
+    Copies one video into rows start:stop of placeholder, offsetting Track IDs
+    and scaling coordinates by conversion as in load_trajectories.
+    """
+
+    assert data.shape[0] == stop - start, "Unexpected number of rows in trajectory file."
+    placeholder[start:stop, :] = data
+    placeholder[start:stop, 0] = placeholder[start:stop, 0] + offset
+    if conversion[0] != 1:
+        placeholder[start:stop, 2:4] = conversion[0] * placeholder[start:stop, 2:4]
+    if conversion[2] != 1:
+        placeholder[start:stop, 4] = conversion[2] * placeholder[start:stop, 4]
+
+
+def _read_videos(filenames, cache=False, n_workers=1, executor='process', info=None, conversion=(1, 1, 1),
+                 cache_dir=None, max_cache_bytes=None):
+    """
+    Reads trajectory files into one array, offsetting the Track IDs of each
+    file by the total number of particles in the files before it and scaling
+    coordinates by conversion.
+
+    With n_workers > 1, the row and particle offsets of every file are found
+    from trajectory_utils.trajectory_file_info before parsing (from the cache
+    if it holds the file), so that each worker writes its file straight into
+    its slice of the preallocated array.  info optionally holds these
+    (rows, last Track ID) pairs already.  Process workers write raw rows into
+    shared memory, and coordinates are scaled as they are copied out of it.
+
+    With max_cache_bytes, each cache directory used is pruned once all files
+    are read, so that no entry is evicted while a worker may be reading it.
+    """
+
+    if n_workers == 1:
+        placeholder = _read_videos_sequential(filenames, cache, conversion, cache_dir)
+    else:
+        placeholder = _read_videos_concurrent(filenames, cache, n_workers, executor, info, conversion, cache_dir)
+
+    if cache and max_cache_bytes is not None:
+        for directory in set(trajectory_cache_dir(filename, cache_dir) for filename in filenames):
+            prune_trajectory_cache(directory, max_cache_bytes)
+
+    return placeholder
+
+
+def _read_videos_sequential(filenames, cache, conversion, cache_dir):
+    """
+    Reads trajectory files one after another, see _read_videos.
+    """
+
+    trajectory = dict()
+    tots = dict()  # Total particles in each video
+    newtots = dict()  # Cumulative total particles.
+    newtots[0] = 0
+    tlen = dict()
+    tlength = dict()
+    tlength[0] = 0
+
+    for num in range(1, len(filenames) + 1):
+        trajectory[num] = read_trajectory(filenames[num-1], cache=cache, cache_dir=cache_dir)
+
+        tots[num] = trajectory[num][-1, 0].astype(np.int64)
+        newtots[num] = newtots[num-1] + tots[num]
+
+        tlen[num] = trajectory[num].shape[0]
+        tlength[num] = tlength[num-1] + tlen[num]
+
+    placeholder = np.zeros((tlength[len(filenames)], 5))
+
+    for num in range(1, len(filenames) + 1):
+        _copy_video(trajectory[num], placeholder, tlength[num-1], tlength[num], newtots[num-1], conversion)
+
+    return placeholder
+
+
+def _read_videos_concurrent(filenames, cache, n_workers, executor, info, conversion, cache_dir):
+    """
+    Reads trajectory files in a pool of n_workers, see _read_videos.
+    """
+
+    if info is None:
+        info = [trajectory_file_info(filename, cache=cache, cache_dir=cache_dir) for filename in filenames]
+    tlength = np.cumsum([0] + [rows for rows, last_id in info])
+    newtots = np.cumsum([0] + [last_id for rows, last_id in info])
+    shape = (int(tlength[-1]), 5)
+    assert shape[0] > 0, "Trajectory files must not be empty."
+
+    if executor == 'thread':
+        placeholder = np.zeros(shape)
+
+        def load(num):
+            _copy_video(read_trajectory(filenames[num], cache=cache, cache_dir=cache_dir), placeholder, tlength[num],
+                        tlength[num+1], newtots[num], conversion)
+
+        with futures.ThreadPoolExecutor(max_workers=n_workers) as pool:
+            list(pool.map(load, range(len(filenames))))
+        return placeholder
+
+    shm = shared_memory.SharedMemory(create=True, size=shape[0]*shape[1]*8)
+    try:
+        with futures.ProcessPoolExecutor(max_workers=n_workers) as pool:
+            jobs = [pool.submit(_read_video_into, filenames[num], shm.name, shape, tlength[num], tlength[num+1],
+                                newtots[num], cache, cache_dir) for num in range(len(filenames))]
+            for job in jobs:
+                job.result()
+        shared = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        placeholder = np.empty(shape)
+        _copy_video(shared, placeholder, 0, shape[0], 0, conversion)
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return placeholder
+
+
+def load_trajectories(folder, name=None, cut=1, totvids=1, conversion=(1, 1, 1), cache=False, n_workers=1,
+                      executor='process', videos=None, pattern=TRAJ_PATTERN, validate=True, gap_strategy='carry',
+                      max_gap=None, dtype=np.float64, ndim=2, cache_dir=None, max_cache_bytes=None):
+    """
+    Loads, filters and fills in trajectories without building frames x
+    particles arrays.
+
+    Parameters
+    ----------
+    folder : string or trajectory_utils.TrajectorySet
+        Directory containing datasets to be analyzed, or a set of trajectory
+        files, in which case name and totvids are ignored.
+    name : string
+        Base name of files to be analzed, see MSD_iteration.
+    cut : integer
+        Minimum number of frames for a trajectory to be included in the final
+        dataset.
+    totvids : integer
+        Total number of csv files to be compiled in the dataset.
+    conversion: list of floats or integers
+        Contains the frames per second associated with the video, the xy pixel
+        resolution, and the z-stack depth respectively.  z is only kept with
+        ndim=3.
+    cache : boolean
+        If True, parsed csv files are cached as binary .npy files, see
+        MSD_iteration.
+    n_workers : integer
+        Number of csv files read concurrently, see MSD_iteration.
+    executor : string
+        'process' or 'thread', see MSD_iteration.
+    videos : list of integers or None
+        Video numbers to be read, see MSD_iteration.
+    pattern : string
+        Filename pattern, see MSD_iteration.
+    validate : boolean
+        If True, the combined dataset is checked, see MSD_iteration.
+    gap_strategy : string
+        'carry', 'linear' or 'missing', see fillin_tracks.
+    max_gap : integer or None
+        If given, trajectories with a gap longer than max_gap frames are left
+        out.
+    dtype : numpy dtype
+        Data type of the coordinates of the output.  Files are parsed in
+        float64 so that Track IDs and frames stay exact.
+    ndim : integer
+        2 for x and y coordinates, 3 to add z coordinates scaled by
+        conversion[2].
+    cache_dir : string or None
+        Cache directory, see MSD_iteration.
+    max_cache_bytes : integer or None
+        Size limit of the cache, see MSD_iteration.
+
+    Returns
+    -------
+    traj : trajectory_utils.RaggedTrajectories
+        Filled in x and y coordinates of every trajectory that passes the cut,
+        stored as flat arrays with per-track offsets.  Memory scales with the
+        number of observations rather than frames x particles, so that many
+        videos can be pooled in one process.  traj.n_frames is the number of
+        frames in the video + 1 and traj.to_dense() gives the frames x
+        particles view returned by MSD_iteration.
+
+    """
+
+    assert type(cut) is int, 'cut must be an integer'
+    assert type(conversion) is tuple, "conversion must be a tuple"
+    assert len(conversion) == 3, "conversion must contain 3 elements"
+    assert type(cache) is bool, "cache must be a boolean"
+    assert type(n_workers) is int and n_workers > 0, "n_workers must be a positive integer"
+    assert executor in ('process', 'thread'), "executor must be 'process' or 'thread'"
+    assert gap_strategy in GAP_STRATEGIES, "gap_strategy must be one of {}".format(GAP_STRATEGIES)
+
+    if isinstance(folder, TrajectorySet):
+        filenames = folder.filenames
+        info = [folder.info(num) for num in folder.videos] if n_workers > 1 else None
+        cache = cache or folder.cache
+        if cache_dir is None:
+            cache_dir = folder.cache_dir
+        if max_cache_bytes is None:
+            max_cache_bytes = folder.max_cache_bytes
+    else:
+        assert type(folder) is str, 'folder must be a string'
+        assert folder[-1] == '/', 'folder must end with a /'
+        assert type(name) is str, 'name must be a string'
+        if videos is None:
+            assert type(totvids) is int, "totvids must be an integer"
+            videos = range(1, totvids + 1)
+
+        index = index_trajectory_files(folder, pattern)
+        assert name in index, 'folder must contain trajectory files of {}'.format(name)
+        for num in videos:
+            assert num in index[name], "folder must contain video {} of {}".format(num, name)
+        filenames = [index[name][num] for num in videos]
+        info = None
+
+    fixed = _read_videos(filenames, cache=cache, n_workers=n_workers, executor=executor, info=info,
+                         conversion=conversion, cache_dir=cache_dir, max_cache_bytes=max_cache_bytes)
+    if validate:
+        report = validate_trajectories(fixed)
+        assert report['valid'], "Invalid trajectory data: " + " ".join(report['errors'])
+    frames = int(np.max(fixed[:, 1]))
+
+    # Rows of each track are found once and reused for the cut and fill in.
+    order, ids, starts, counts = group_tracks(fixed[:, 0])
+    fixed = fixed[order]
+    keep = (ids >= 1) & (counts - 1 >= cut)
+    if max_gap is not None:
+        keep = keep & (gap_statistics(fixed, starts, counts)[1] <= max_gap)
+
+    traj = fillin_tracks(fixed, starts[keep], counts[keep], n_frames=frames+1, gap_strategy=gap_strategy, ndim=ndim)
+    traj.coords = traj.coords.astype(dtype, copy=False)
+
+    return traj
+
+
+def MSD_iteration(folder, name=None, cut=1, totvids=1, conversion=(1, 1, 1), cache=False, n_workers=1,
+                  executor='process', out_dir=None, videos=None, pattern=TRAJ_PATTERN, validate=True,
+                  gap_strategy='carry', max_gap=None, fill_value=0, dtype=np.float64, cache_dir=None,
+                  max_cache_bytes=None):
     """
     Arranges trajectory xy data into numpy arrays of dimensions frames x particles
 
     Parameters
     ----------
-    folder : string
-        Directory containing datasets to be analyzed.
+    folder : string or trajectory_utils.TrajectorySet
+        Directory containing datasets to be analyzed.  If a TrajectorySet is
+        given, only its videos are read and name and totvids are ignored.
     name : string
-        Base name of files to be analzed.  The code has a very specific naming
-        convenction, and requires files to be of the structure:
+        Base name of files to be analzed.  By default files must be of the
+        structure:
 
-        Traj_{}_{}.csv.format(name, video_number)
+        Traj_{}_{}.tif.csv.format(name, video_number)
 
         where name is the base name of the files and video number is the number
-        associated with the video.  Numbers must begin at 1 and increase in
-        units of 1.
+        associated with the video.  Unless videos is given, numbers must begin
+        at 1 and increase in units of 1.  Other naming conventions can be
+        given with pattern.
     cut : integer
         Minimum number of frames for a trajectory to be included in the final
         dataset.  Trajectories in the csv file with less datasets will be cut
@@ -113,8 +569,60 @@ def MSD_iteration(folder, name, cut=1, totvids=1, conversion=(1, 1, 1)):
         Total number of csv files to be compiled in the dataset.
     conversion: list of floats or integers
         Contains the frames per second associated with the video, the xy pixel
-        resolution, and the z-stack depth respectively.  Currently the code
-        discards z information.
+        resolution, and the z-stack depth respectively.  z is discarded here,
+        use MSD_coordinates(..., ndim=3) to keep it.
+    cache : boolean
+        If True, parsed csv files are cached as binary .npy files in a
+        .traj_cache folder inside folder, so that repeated runs on unchanged
+        files skip the csv parse.  See trajectory_utils.read_trajectory.
+    cache_dir : string or None
+        Directory of the cache instead of the .traj_cache folder.
+    max_cache_bytes : integer or None
+        If given, least recently used cache entries are evicted after the
+        files are read until the cache is no larger than max_cache_bytes.
+    n_workers : integer
+        Number of csv files read concurrently.  With more than one worker the
+        row and particle offsets of each file are found before parsing and
+        every file is written straight into its rows of the combined dataset.
+    executor : string
+        'process' reads files in a pool of worker processes that write into
+        shared memory; 'thread' uses a pool of threads instead.
+    out_dir : string or None
+        If given, the output arrays are views of numpy.memmap arrays backed by
+        xy_{name}.npy (x_m and y_m) and xys_{name}.npy (xs_m and ys_m) in
+        out_dir, of dimensions frames x particles x 2, instead of arrays held
+        in memory.
+    videos : list of integers or None
+        Video numbers to be read, which don't need to start at 1 or be
+        contiguous.  If given, totvids is ignored.
+    pattern : string
+        Regular expression used to find the trajectory files of each sample
+        in folder with a single directory scan, see
+        trajectory_utils.index_trajectory_files.
+    validate : boolean
+        If True, all trajectories are checked in one vectorized pass for
+        non-finite values, frames decreasing within a track and repeated
+        frames (see trajectory_utils.validate_trajectories), and an
+        AssertionError listing every problem found is raised.  Can be
+        switched off in production runs on data known to be clean.
+    gap_strategy : string
+        How frames in which a particle wasn't found are filled in.  'carry'
+        (the default) carries the last position forward, which biases
+        short-lag MSDs downward because displacements across gaps are zero.
+        'linear' interpolates between the positions around the gap, and
+        'missing' leaves the gap at 0 in the output arrays so that it is
+        excluded from MSDs.  See fillin_tracks.
+    max_gap : integer or None
+        If given, trajectories with a gap longer than max_gap frames are left
+        out, see gap_statistics.
+    fill_value : float
+        Value given to frames in which a particle isn't present.  np.nan
+        keeps real coordinates of 0 apart from missing positions, see
+        vectorized_MMSD_calcs.
+    dtype : numpy dtype
+        Data type of the output arrays.  np.float32 halves their memory, and
+        keeps about 7 significant digits of each coordinate, which is more
+        than tracking provides.
 
     Returns
     -------
@@ -125,7 +633,7 @@ def MSD_iteration(folder, name, cut=1, totvids=1, conversion=(1, 1, 1)):
     x_m : numpy array of dimensions frames x particles
         Contains x coordinates of all trajectories in all csv files being
         analyzed.  If a particle isn't present in a frame, then it is filled in
-        with a 0.
+        with fill_value, 0 by default.
     y_m : numpy array of dimensions frames x particles
         Similar to x_m with y coordinates.
     xs_m : numpy array of dimensions frames x particles
@@ -155,92 +663,417 @@ def MSD_iteration(folder, name, cut=1, totvids=1, conversion=(1, 1, 1)):
 
     """
 
-    assert type(folder) is str, 'folder must be a string'
-    assert folder[-1] == '/', 'folder must end with a /'
-    assert type(name) is str, 'name must be a string'
-    assert 'Traj_{}_1.tif.csv'.format(name) in os.listdir(folder), 'folder must contain Traj_{}_1_.tif.csv'.format(name)
-    assert type(cut) is int, 'cut must be an integer'
-    assert type(totvids) is int, "totvids must be an integer"
-    for i in range(1, totvids+1):
-        assert 'Traj_{}_{}.tif.csv'.format(name, i) in os.listdir(folder), "folder must contain 'Traj_{}_{}_.tif.csv".format(name, i)
-    assert type(conversion) is tuple, "conversion must be a tuple"
-    assert len(conversion) == 3, "conversion must contain 3 elements"
+    total1, frames, dense_s, dense = MSD_coordinates(folder, name, cut=cut, totvids=totvids, conversion=conversion,
+                                                     cache=cache, n_workers=n_workers, executor=executor,
+                                                     out_dir=out_dir, videos=videos, pattern=pattern,
+                                                     validate=validate, gap_strategy=gap_strategy, max_gap=max_gap,
+                                                     fill_value=fill_value, dtype=dtype, cache_dir=cache_dir,
+                                                     max_cache_bytes=max_cache_bytes)
+    x_m = dense[:, :, 0]
+    y_m = dense[:, :, 1]
+    xs_m = dense_s[:, :, 0]
+    ys_m = dense_s[:, :, 1]
 
-    frames = 0
-    trajectory = dict()
-    tots = dict()  # Total particles in each video
-    newtots = dict()  # Cumulative total particles.
-    newtots[0] = 0
-    tlen = dict()
-    tlength = dict()
-    tlength[0] = 0
+    return total1, frames, xs_m, ys_m, x_m, y_m
 
-    for num in range(1, totvids + 1):
-        trajectory[num] = np.genfromtxt(folder+'Traj_{}_{}.tif.csv'.format(name, num), delimiter=",")
-        trajectory[num] = np.delete(trajectory[num], 0, 0)
-        trajectory[num] = np.delete(trajectory[num], 0, 1)
 
-        tots[num] = trajectory[num][-1, 0].astype(np.int64)
-        newtots[num] = newtots[num-1] + tots[num]
+def MSD_coordinates(folder, name=None, cut=1, totvids=1, conversion=(1, 1, 1), cache=False, n_workers=1,
+                    executor='process', out_dir=None, videos=None, pattern=TRAJ_PATTERN, validate=True,
+                    gap_strategy='carry', max_gap=None, fill_value=0, dtype=np.float64, ndim=2, cache_dir=None,
+                    max_cache_bytes=None):
+    """
+    Same as MSD_iteration, but returns the coordinates of all axes stacked in
+    one array, and can keep z coordinates.
 
-        tlen[num] = trajectory[num].shape[0]
-        tlength[num] = tlength[num-1] + tlen[num]
+    Parameters
+    ----------
+    ndim : integer
+        2 for x and y coordinates, 3 to add z coordinates scaled by
+        conversion[2].
+    Others : see MSD_iteration.  With out_dir, the arrays are backed by
+        xy_{name}.npy and xys_{name}.npy, or xyz_{name}.npy and
+        xyzs_{name}.npy if ndim is 3.
 
-        if np.max(trajectory[num][:, 1]) > frames:
-            frames = int(np.max(trajectory[num][:, 1]))
+    Returns
+    -------
+    total1 : integer
+        Total number of particles contained in all csv files being analyzed.
+    frames : integer
+        Total number of frames in the video.
+    coords_s : numpy array of dimensions frames x particles x ndim
+        Coordinates of all trajectories, shifted such that all trajectories
+        begin at frame 0, as can be passed to vectorized_MMSD_calcs.
+    coords : numpy array of dimensions frames x particles x ndim
+        Coordinates of all trajectories at their original frames.
 
-    placeholder = np.zeros((tlength[totvids], 11))
+    Examples
+    --------
+    >>> total1, frames, coords_s, coords = MSD_coordinates('../', 'test_data', ndim=3)
+    >>> vectorized_MMSD_calcs(frames, total1, coords_s)
 
-    for num in range(1, totvids + 1):
-        placeholder[tlength[num-1]:tlength[num], :] = trajectory[num]
-        placeholder[tlength[num-1]:tlength[num], 0] = placeholder[tlength[num-1]:tlength[num], 0] + newtots[num-1]
+    """
 
-    dataset = dict()
-    rawdataset = np.zeros(placeholder.shape)
-    particles = placeholder[:, 0]
-    total = int(max(particles))
-    total1 = total + 1
-    rawdataset = placeholder[:, :]
+    traj = load_trajectories(folder, name, cut=cut, totvids=totvids, conversion=conversion, cache=cache,
+                             n_workers=n_workers, executor=executor, videos=videos, pattern=pattern,
+                             validate=validate, gap_strategy=gap_strategy, max_gap=max_gap, dtype=dtype, ndim=ndim,
+                             cache_dir=cache_dir, max_cache_bytes=max_cache_bytes)
 
-    fixed = np.zeros(placeholder.shape)
-    fixed[:, 0:2] = rawdataset[:, 0:2]
-    fixed[:, 2:4] = conversion[0] * rawdataset[:, 2:4]
-    fixed[:, 4] = conversion[2] * rawdataset[:, 4]
+    total1 = len(traj)
+    frames = traj.n_frames - 1
+    if out_dir is None:
+        coords = traj.to_dense(fill_value=fill_value)
+        coords_s = traj.to_dense(shifted=True, fill_value=fill_value)
+    else:
+        if isinstance(folder, TrajectorySet):
+            name = folder.name
+        shape = (traj.n_frames, total1, ndim)
+        label = 'xyz'[:ndim]
+        coords = traj.to_dense(fill_value=fill_value, out=_output_array(shape, out_dir, label, name, dtype))
+        coords_s = traj.to_dense(shifted=True, fill_value=fill_value,
+                                 out=_output_array(shape, out_dir, label + 's', name, dtype))
 
-    x = np.zeros((frames+1, total1))
-    y = np.zeros((frames+1, total1))
-    xs = np.zeros((frames+1, total1))
-    ys = np.zeros((frames+1, total1))
+    return total1, frames, coords_s, coords
 
-    nones = 0
-    cutoff = cut
-    for num in range(1, total1):
 
-        hold = np.where(particles == num)
-        itindex = hold[0]
-        min1 = min(itindex)
-        max1 = max(itindex)
+# Approximate size in bytes of the block of columns processed at a time when
+# MSD outputs are memory-mapped.
+MMAP_BLOCK_BYTES = 2**26
 
-        if max1 - min1 < cutoff:
-            nones = nones + 1
-        else:
-            holdplease = fillin2(fixed[min1:max1+1, 0:5])
-            x[int(holdplease[0, 1]):int(holdplease[-1, 1])+1, num - nones - 1] = holdplease[:, 2]
-            y[int(holdplease[0, 1]):int(holdplease[-1, 1])+1, num - nones - 1] = holdplease[:, 3]
+# Default working memory, in bytes, of each chunk of particles in
+# vectorized_MMSD_calcs.
+CHUNK_BYTES = 2**23
 
-            xs[0:int(holdplease[-1, 1])+1-int(holdplease[0, 1]), num - nones - 1] = holdplease[:, 2]
-            ys[0:int(holdplease[-1, 1])+1-int(holdplease[0, 1]), num - nones - 1] = holdplease[:, 3]
 
-    total1 = total1 - nones - 1
-    x_m = x[:, :total1]
-    y_m = y[:, :total1]
-    xs_m = xs[:, :total1]
-    ys_m = ys[:, :total1]
+def _output_array(shape, out_dir=None, label='', name=None, dtype=np.float64):
+    """
+    Allocates an output array of zeros, backed by a .npy file in out_dir if
+    out_dir is given.
+    """
 
-    return total1, frames, xs_m, ys_m, x_m, y_m
+    if out_dir is None:
+        return np.zeros(shape, dtype=dtype)
+
+    assert os.path.isdir(out_dir), "out_dir must be an existing directory"
+    filename = '{}_{}.npy'.format(label, name) if name else '{}.npy'.format(label)
+    return np.lib.format.open_memmap(os.path.join(out_dir, filename), mode='w+', dtype=dtype, shape=shape)
+
+
+def _log_moments(SM2xy):
+    """
+    Returns the count, mean and sum of squared deviations of the logs of the
+    positive entries in each row of SM2xy.
+    """
+
+    valid = SM2xy > 0
+    count = np.sum(valid, axis=1)
+    logs = np.log(np.where(valid, SM2xy, 1))
+    mean = np.sum(logs, axis=1) / np.maximum(count, 1)
+    M2 = np.sum(np.where(valid, logs - mean[:, np.newaxis], 0)**2, axis=1)
+
+    return count, mean, M2
+
+
+def _merge_moments(first, second):
+    """
+    Combines the output of _log_moments for two blocks of columns.
+    """
+
+    count_a, mean_a, M2_a = first
+    count_b, mean_b, M2_b = second
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    weight = count_b / np.maximum(count, 1)
+    mean = mean_a + delta*weight
+    M2 = M2_a + M2_b + delta**2 * count_a * weight
+
+    return count, mean, M2
+
+
+def _geometric_stats(moments):
+    """
+    Converts the output of _log_moments into the average and standard error
+    of the log MSDs at each frame.  Frames without MSDs average to 0, and the
+    standard error is nan where fewer than two MSDs are available.
+    """
+
+    count, mean, M2 = moments
+    geoM2xy = np.where(count > 0, mean, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gSEM = np.where(count > 1, np.sqrt(M2 / (count - 1) / count), np.nan)
+
+    return geoM2xy, gSEM
+
+
+def _missing_mask(values, missing=0, joint=False):
+    """
+    Sets missing positions of the float64 array values to 0 in place, and
+    returns a boolean array that is True where a position was found.  NaNs
+    are always missing, and so are entries equal to missing unless missing
+    is NaN.
+
+    With joint=True, values is of dimensions frames x particles x ndim and
+    each position is found or missing along all axes at once: it is missing
+    if any axis is NaN or every axis equals missing, so that a coordinate
+    that is really 0 along one axis is kept.  found is then of dimensions
+    frames x particles x 1.
+    """
+
+    found = ~np.isnan(values)
+    if joint:
+        found = np.all(found, axis=2, keepdims=True)
+        if not np.isnan(missing):
+            found &= np.any(values != missing, axis=2, keepdims=True)
+    elif not np.isnan(missing):
+        found &= values != missing
+    np.copyto(values, 0, where=~found)
+
+    return found
+
+
+def log_lags(max_lag, n_lags=20, min_lag=1):
+    """
+    Returns about n_lags integer lags from min_lag to max_lag, evenly spaced
+    on a log scale, for use as the lags of vectorized_MMSD_calcs.
+
+    Parameters
+    ----------
+    max_lag : integer
+        Largest lag, in frames.
+    n_lags : integer
+        Number of log-spaced points.  Fewer lags are returned where points
+        round to the same integer.
+    min_lag : integer
+        Smallest lag, in frames.
+
+    Returns
+    -------
+    lags : numpy array of integers
+        Unique lags in ascending order.
+
+    Examples
+    --------
+    >>> log_lags(100, 5)
+    array([  1,   3,  10,  32, 100])
+
+    """
+
+    assert type(max_lag) is int, "max_lag must be an integer"
+    assert type(n_lags) is int, "n_lags must be an integer"
+    assert 1 <= min_lag <= max_lag, "lags must satisfy 1 <= min_lag <= max_lag"
+
+    return np.unique(np.rint(np.geomspace(min_lag, max_lag, n_lags)).astype(np.int64))
+
+
+def _lag_displacements(values, found, lag):
+    """
+    Returns the displacements at lag of the coordinates values, of dimensions
+    frames x particles x ndim, set to 0 where the positions at either end
+    weren't both found, and the mask of the pairs that were.
+    """
+
+    pairs = found[lag:] & found[:-lag]
+    steps = values[lag:] - values[:-lag]
+    if pairs.shape[2] == steps.shape[2]:
+        steps *= pairs
+    else:
+        # Broadcasting a mask shared by all axes over the last axis is
+        # several times slower than applying it to each axis in turn.
+        for dim in range(steps.shape[2]):
+            steps[:, :, dim] *= pairs[:, :, 0]
+
+    return steps, pairs
+
+
+def _fft_msd(values, found, lags):
+    """
+    Sums of squared displacements of each column of values at each of lags,
+    and the number of displacements summed, using only pairs of positions
+    that were both found.  Sums at lag 0 are 0.  They are found from the
+    correlations C(a, b)[lag] = sum_t a[t]*b[t+lag]
+    of w, w*x and w*x**2, where w is 1 where a position was found:
 
+    sum_t w[t]*w[t+lag]*(x[t+lag] - x[t])**2 =
+        C(w, w*x**2) + C(w*x**2, w) - 2*C(w*x, w*x)
 
-def vectorized_MMSD_calcs(frames, total1, xs_m, ys_m):
+    Columns are centered on their mean first to limit cancellation.
+    """
+
+    weights = found.astype(np.float64)
+    count = np.sum(weights, axis=0)
+    centered = values - np.sum(values, axis=0) / np.maximum(count, 1)
+    centered *= weights
+    squares = centered**2
+
+    size = sfft.next_fast_len(2*values.shape[0])
+    W = sfft.rfft(weights, size, axis=0)
+    S = sfft.rfft(squares, size, axis=0)
+    X = sfft.rfft(centered, size, axis=0)
+    total = sfft.irfft(2*(np.conj(W)*S).real - 2*(X.real**2 + X.imag**2), size, axis=0)[lags]
+    count = np.rint(sfft.irfft(W.real**2 + W.imag**2, size, axis=0)[lags]).astype(np.int64)
+
+    # Rounding errors are of the order of eps times the sum of squares.
+    tolerance = 64 * np.finfo(np.float64).eps * np.sum(squares, axis=0)
+    total[total <= tolerance] = 0
+    total[lags == 0, :] = 0
+
+    return total, count
+
+
+def _lag_sums(values, found, lags):
+    """
+    Yields, at each of lags in turn, the row of the lag, the sums of squared
+    displacements of each particle along each axis of the coordinates values
+    (of dimensions frames x particles x ndim), the numbers of displacements
+    summed, the displacements and the mask of found pairs (None at lag 0).
+    Pairs of positions not both found are left out.  Only one lag's worth of
+    temporaries is held at a time.
+    """
+
+    for row, lag in enumerate(lags):
+        if lag == 0:
+            yield row, np.zeros(values.shape[1:]), np.count_nonzero(found, axis=0), None, None
+            continue
+        steps, pairs = _lag_displacements(values, found, lag)
+        yield row, np.einsum('ijk,ijk->jk', steps, steps), np.count_nonzero(pairs, axis=0), steps, pairs
+
+
+def _write_msds(SM1x, SM1y, SM2xy, rows, cols, total, count):
+    """
+    Writes the MSDs from the sums of squared displacements total and the
+    numbers of displacements count, of dimensions particles x ndim or
+    lags x particles x ndim, into rows and cols of SM1x, SM1y and SM2xy (any
+    of which can be None), and returns the MSDs summed over axes.
+    """
+
+    if SM1x is None and SM1y is None and count.shape[-1] == 1:
+        # Axes share their counts, so only the sum over axes is divided.
+        MSD = np.sum(total, axis=-1)
+        MSD /= np.maximum(count[..., 0], 1)
+    else:
+        MSD = np.divide(total, count, out=np.zeros(total.shape), where=count > 0)
+        for dim, SM in ((0, SM1x), (1, SM1y)):
+            if SM is not None:
+                SM[rows, cols] = MSD[..., dim]
+        MSD = np.sum(MSD, axis=-1)
+    if SM2xy is not None:
+        SM2xy[rows, cols] = MSD
+
+    return MSD
+
+
+_MSD_ALGORITHMS = ('direct', 'fft')
+
+# Approximate number of float64 temporaries of the length of a trajectory
+# used per particle by each algorithm, to size chunks to a memory budget.
+_MSD_WORKING_ARRAYS = {'direct': 4, 'fft': 16}
+
+
+def _chunk_columns(total1, length, algorithm, chunk_size=None, memory_limit=None):
+    """
+    Returns the number of particles processed at a time by
+    vectorized_MMSD_calcs.
+    """
+
+    if chunk_size is not None:
+        assert type(chunk_size) is int and chunk_size > 0, "chunk_size must be a positive integer"
+        return chunk_size
+    if memory_limit is None:
+        memory_limit = CHUNK_BYTES
+    return max(1, int(memory_limit // (8 * _MSD_WORKING_ARRAYS[algorithm] * max(length, 1))))
+
+
+# Per-particle MSD arrays that vectorized_MMSD_calcs can return.
+MSD_OUTPUTS = ('SM1x', 'SM1y', 'SM2xy')
+
+
+def _msd_chunk(axes, SM1x, SM1y, SM2xy, cols, missing, algorithm, lags, accumulators=(), joint=False):
+    """
+    Writes the MSDs of the particles in columns cols of the coordinate arrays
+    axes into SM1x, SM1y and SM2xy (any of which can be None), adds the chunk
+    to each of accumulators, and returns the log moments of the MSDs summed
+    over axes.
+
+    The coordinates of all axes are copied into one float64 array of
+    dimensions frames x particles x ndim, so that each lag is one vectorized
+    operation over every axis.  With algorithm='direct', MSDs are written to
+    the outputs one lag at a time, without temporaries of dimensions
+    lags x particles.  With algorithm='fft', which finds every lag at once,
+    they are written as one block.  joint is passed to _missing_mask.
+    """
+
+    values = np.empty((axes[0].shape[0], cols.stop - cols.start, len(axes)))
+    for dim, axis in enumerate(axes):
+        values[:, :, dim] = axis[:, cols]
+    found = _missing_mask(values, missing, joint)
+
+    for accumulator in accumulators:
+        accumulator.update(values, found)
+    displacements = any(accumulator.displacements for accumulator in accumulators)
+
+    if algorithm == 'fft':
+        # The sums of all lags are found at once, so they are written as one block.
+        shape = values.shape
+        total, count = _fft_msd(values.reshape(shape[0], -1), np.broadcast_to(found, shape).reshape(shape[0], -1),
+                                lags)
+        total = total.reshape((len(lags),) + shape[1:])
+        count = count.reshape((len(lags),) + shape[1:])
+        moments = _log_moments(_write_msds(SM1x, SM1y, SM2xy, slice(None), cols, total, count))
+
+        if len(accumulators) > 0:
+            for row, lag in enumerate(lags):
+                # Displacements are only formed for the accumulators that need them.
+                steps, pairs = None, None
+                if displacements and lag > 0:
+                    steps, pairs = _lag_displacements(values, found, lag)
+                for accumulator in accumulators:
+                    accumulator.update_lag(row, total[row], count[row], steps, pairs)
+
+        return moments
+
+    moments = tuple(np.zeros(len(lags)) for moment in range(3))
+    for row, total, count, steps, pairs in _lag_sums(values, found, lags):
+        MSD = _write_msds(SM1x, SM1y, SM2xy, row, cols, total, count)
+
+        # Statistics come from the float64 MSDs, whatever the output dtype.
+        for moment, value in zip(moments, _log_moments(MSD[np.newaxis, :])):
+            moment[row] = value[0]
+
+        for accumulator in accumulators:
+            accumulator.update_lag(row, total, count, steps, pairs)
+
+    return moments
+
+
+def _msd_shard_into(coords_name, coords_shape, msds_name, msds_shape, start, stop, missing, algorithm, lags,
+                    coords_dtype=np.float64, dtype=np.float64, accumulators=(), outputs=MSD_OUTPUTS,
+                    joint=False):
+    """
+    Calculates the MSDs of particles start to stop from stacked coordinates
+    in shared memory, and writes them into an array in shared memory that
+    holds each of outputs in turn.  Returns the log moments of the shard and
+    the accumulators updated with it.
+    """
+
+    coords_shm = shared_memory.SharedMemory(name=coords_name)
+    msds_shm = shared_memory.SharedMemory(name=msds_name)
+    try:
+        coords = np.ndarray(coords_shape, dtype=coords_dtype, buffer=coords_shm.buf)
+        msds = np.ndarray(msds_shape, dtype=dtype, buffer=msds_shm.buf)
+        SM1x, SM1y, SM2xy = [msds[outputs.index(label)] if label in outputs else None for label in MSD_OUTPUTS]
+        moments = _msd_chunk([coords[:, :, dim] for dim in range(coords_shape[2])], SM1x, SM1y, SM2xy,
+                             slice(start, stop), missing, algorithm, lags, accumulators, joint)
+        del SM1x, SM1y, SM2xy
+        del coords, msds
+    finally:
+        coords_shm.close()
+        msds_shm.close()
+
+    return moments, accumulators
+
+
+def vectorized_MMSD_calcs(frames, total1, xs_m, ys_m=None, out_dir=None, name=None, missing=0, algorithm='direct',
+                          lags=None, max_lag=None, chunk_size=None, memory_limit=None, n_jobs=1, dtype=np.float64,
+                          accumulators=(), outputs=MSD_OUTPUTS):
     """
     Calculates the geometrically averaged mean squared displacement of the input trajectories.
 
@@ -254,14 +1087,93 @@ def vectorized_MMSD_calcs(frames, total1, xs_m, ys_m):
     xs_m : numpy array of dimensions frames x particles
         Contains x coordinates of all trajectories in all csv files being
         analyzed.  Trajectories have been shifted such that all trajectories
-        begin at frame 0. Output from MSD_iteration.
-    ys_m : numpy array of dimensions frames x particles
+        begin at frame 0. Output from MSD_iteration.  Can also be the stacked
+        coordinates of dimensions frames x particles x ndim output from
+        MSD_coordinates, including z if ndim is 3, with ys_m None.  The MSDs
+        of all axes are then found in one vectorized pass, and SM2xy and
+        geoM2xy are the MSDs summed over all ndim axes.  Each position is then
+        found or missing along all axes at once, see missing.
+    ys_m : numpy array of dimensions frames x particles or None
         Similar to xs_m with y coordinates. Output from MSD_iteration.
+    out_dir : string or None
+        If given, SM1x, SM1y and SM2xy are numpy.memmap arrays backed by .npy
+        files in out_dir, named e.g. SM2xy_{name}.npy, and particles are
+        processed in chunks so that memory use stays bounded, see memory_limit.
+        xs_m and ys_m can themselves be memory-mapped, see MSD_iteration.
+    name : string or None
+        Sample name used in the output filenames.
+    missing : float
+        Value marking the frames in which a particle wasn't found.  The
+        default of 0 matches the zero padding of MSD_iteration, but also
+        leaves out real coordinates that are exactly 0.  Use np.nan with
+        MSD_iteration(..., fill_value=np.nan) to avoid this.  NaNs are
+        always treated as missing.  With stacked xs_m, a position is missing
+        if any axis is NaN or every axis equals missing, so a coordinate of 0
+        along one axis is kept.  With xs_m and ys_m, each axis is masked on
+        its own.
+    algorithm : string
+        'direct' takes the differences of every pair of frames at each lag,
+        which costs O(frames**2) per particle.  'fft' gets the sums of
+        squared displacements at all lags from FFT correlations in
+        O(frames log frames) per particle, and is much faster for long
+        videos.  Results agree to rounding error.
+    lags : list of integers or None
+        Lags, in frames, at which MSDs are calculated, e.g. from log_lags.
+        Row i of the outputs is then the MSD at lags[i], and only those lags
+        are computed and stored.
+    max_lag : integer or None
+        If given instead of lags, MSDs are calculated at lags 0 to max_lag
+        only, and row i of the outputs is still the MSD at lag i.  By default
+        all lags below frames are calculated.
+    chunk_size : integer or None
+        Number of particles processed at a time.  The MSDs of each chunk of
+        columns are written straight into SM1x, SM1y and SM2xy, and geoM2xy
+        and gSEM are merged from the log MSD statistics of each chunk, so
+        working memory is bounded by the chunk rather than the whole input.
+    memory_limit : integer or None
+        Approximate working memory in bytes, used to choose chunk_size when
+        it isn't given.  Defaults to CHUNK_BYTES, or to MMAP_BLOCK_BYTES if
+        out_dir is given.
+    n_jobs : integer
+        Number of worker processes.  With more than one, xs_m and ys_m are
+        copied once into shared memory, chunks of particles (at most
+        total1/n_jobs each) are processed in a process pool that writes MSDs
+        into shared memory, and the results are copied into the outputs in
+        particle order.  The MSDs themselves are never pickled: each job
+        sends its chunk bounds and a copy of accumulators, and returns its
+        log moments and the updated accumulators.  Accumulators are small
+        except for those with results per particle, such as
+        accumulators.NonGaussian(per_track=True), whose sums of each chunk
+        (3 x lags x particles) are pickled back.
+        As the whole input and outputs are then held in shared memory, n_jobs
+        can't be combined with out_dir.
+    dtype : numpy dtype
+        Data type of SM1x, SM1y and SM2xy, and of the shared memory used with
+        n_jobs.  Differences and sums of squares are always taken in float64,
+        one chunk at a time, and geoM2xy and gSEM are float64.  With
+        np.float32 the stored MSDs have a relative rounding error below
+        2**-24 (about 6e-8).  If xs_m and ys_m are float32 too, each position
+        is rounded by up to |x|*2**-24, so an MSD of displacements of size d
+        is accurate to about 2*|x|*2**-24/d relative to its value, e.g. 1e-5
+        for 1 nm steps at 100 um from the origin in um units.
+    accumulators : list
+        Objects that collect further statistics in the same pass over the
+        data, such as accumulators.EnsembleMSD, accumulators.VanHove or
+        accumulators.NonGaussian.  Each is reset to the lags of the
+        calculation, updated with every chunk of particles (in worker
+        processes with n_jobs, then merged in particle order), and holds its
+        results when vectorized_MMSD_calcs returns.
+    outputs : tuple of strings
+        Which of 'SM1x', 'SM1y' and 'SM2xy' to allocate and return.  The
+        others are returned as None.  outputs=('SM2xy',) allocates one
+        lags x particles array instead of three, and outputs=() keeps only
+        geoM2xy, gSEM and the accumulators.
 
     Returns
     -------
     geoM2xy : frames x 1 numpy.ndarray of float64s
-        Average of the log 2D MSDs of input xy data.
+        Average of the log 2D MSDs of input xy data.  With lags or max_lag,
+        this and the other outputs have one row per lag instead of frames.
     gSEM : frames x 1 numpy.ndarray of float64s
         Standard error of the log 2D MSDs of input xy data.
     SM1x : frames x total1 numpy.ndarray of float64s
@@ -269,7 +1181,8 @@ def vectorized_MMSD_calcs(frames, total1, xs_m, ys_m):
     SM1y : frames x total1 numpy.ndarray of float64s
         y component of the 2D MSD of input xy data for each trajectory.
     SM2xy : frames x total1 numpy.ndarray of float64s
-        2D MSDs of input xy data for each trajectory.
+        2D MSDs of input xy data for each trajectory.  Each of SM1x, SM1y
+        and SM2xy is None unless it is in outputs.
 
     Examples
     --------
@@ -343,39 +1256,163 @@ def vectorized_MMSD_calcs(frames, total1, xs_m, ys_m):
 
     assert type(frames) is int, 'frames must be an integer'
     assert type(total1) is int, 'total1 must be an integer'
-    assert type(xs_m) is np.ndarray, 'xs_m must be a numpy array'
-    assert type(ys_m) is np.ndarray, 'ys_m must an a numpy array'
-    assert xs_m.shape == ys_m.shape, 'xs_m and ys_m must be the same size'
+    assert isinstance(xs_m, np.ndarray), 'xs_m must be a numpy array'
+    if ys_m is None:
+        assert xs_m.ndim == 3, 'xs_m must be of dimensions frames x particles x ndim if ys_m is None'
+        axes = [xs_m[:, :, dim] for dim in range(xs_m.shape[2])]
+        joint = True
+    else:
+        assert isinstance(ys_m, np.ndarray), 'ys_m must an a numpy array'
+        assert xs_m.shape == ys_m.shape, 'xs_m and ys_m must be the same size'
+        axes = [xs_m, ys_m]
+        joint = False
+    ndim = len(axes)
+    assert algorithm in _MSD_ALGORITHMS, "algorithm must be one of {}".format(tuple(_MSD_ALGORITHMS))
 
-    SM1x = np.zeros((frames, total1))
-    SM1y = np.zeros((frames, total1))
-    SM2xy = np.zeros((frames, total1))
+    assert lags is None or max_lag is None, "Only one of lags and max_lag can be given"
+    assert type(n_jobs) is int and n_jobs > 0, "n_jobs must be a positive integer"
+    assert n_jobs == 1 or out_dir is None, "n_jobs can't be combined with out_dir, which bounds memory use"
 
-    xs_m = ma.masked_equal(xs_m, 0)
-    ys_m = ma.masked_equal(ys_m, 0)
+    if lags is None:
+        lags = np.arange(frames if max_lag is None else max_lag + 1)
+    lags = np.asarray(lags, dtype=np.int64)
+    assert lags.ndim == 1, "lags must be a list of integers"
+    assert np.all((lags >= 0) & (lags < max(frames, 1))), "lags must be between 0 and frames - 1"
+    n_lags = lags.shape[0]
 
-    geoM1x = np.zeros(frames)
-    geoM1y = np.zeros(frames)
+    assert all(label in MSD_OUTPUTS for label in outputs), "outputs must be chosen from {}".format(MSD_OUTPUTS)
+    outputs = tuple(label for label in MSD_OUTPUTS if label in outputs)
 
-    for frame in range(1, frames):
-        bx = xs_m[frame:, :]
-        cx = xs_m[:-frame, :]
-        Mx = (bx - cx)**2
-        Mxa = np.mean(Mx, axis=0)
+    for accumulator in accumulators:
+        accumulator.reset(lags, ndim)
 
-        by = ys_m[frame:, :]
-        cy = ys_m[:-frame, :]
-        My = (by - cy)**2
-        Mya = np.mean(My, axis=0)
+    SM1x, SM1y, SM2xy = [_output_array((n_lags, total1), out_dir, label, name, dtype) if label in outputs else None
+                         for label in MSD_OUTPUTS]
 
-        SM1x[frame, :] = Mxa
-        SM1y[frame, :] = Mya
+    if out_dir is not None and memory_limit is None:
+        memory_limit = MMAP_BLOCK_BYTES
+    block = _chunk_columns(total1, xs_m.shape[0] * ndim, algorithm, chunk_size, memory_limit)
 
-    SM2xy = SM1x + SM1y
-    dist = ma.log(ma.masked_equal(SM2xy, 0))
+    moments = (np.zeros(n_lags), np.zeros(n_lags), np.zeros(n_lags))
+    if n_jobs == 1:
+        for start in range(0, total1, block):
+            cols = slice(start, min(start + block, total1))
+            moments = _merge_moments(moments, _msd_chunk(axes, SM1x, SM1y, SM2xy, cols, missing, algorithm, lags,
+                                                         accumulators, joint))
+    else:
+        block = max(1, min(block, -(-total1 // n_jobs)))
+        coords_shape = axes[0].shape + (ndim,)
+        msds_shape = (len(outputs), n_lags, total1)
+        coords_dtype = np.result_type(*axes)
+        coords_shm = shared_memory.SharedMemory(create=True, size=max(np.dtype(coords_dtype).itemsize *
+                                                                      int(np.prod(coords_shape)), 1))
+        msds_shm = shared_memory.SharedMemory(create=True, size=max(np.dtype(dtype).itemsize *
+                                                                    int(np.prod(msds_shape)), 1))
+        try:
+            coords = np.ndarray(coords_shape, dtype=coords_dtype, buffer=coords_shm.buf)
+            for dim, axis in enumerate(axes):
+                coords[:, :, dim] = axis
+            with futures.ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                jobs = [pool.submit(_msd_shard_into, coords_shm.name, coords_shape, msds_shm.name, msds_shape,
+                                    start, min(start + block, total1), missing, algorithm, lags,
+                                    coords_dtype, dtype, copy.deepcopy(accumulators), outputs, joint)
+                        for start in range(0, total1, block)]
+                for job in jobs:
+                    shard_moments, shard_accumulators = job.result()
+                    moments = _merge_moments(moments, shard_moments)
+                    for accumulator, shard_accumulator in zip(accumulators, shard_accumulators):
+                        accumulator.merge(shard_accumulator)
+            msds = np.ndarray(msds_shape, dtype=dtype, buffer=msds_shm.buf)
+            for label, SM in zip(MSD_OUTPUTS, (SM1x, SM1y, SM2xy)):
+                if SM is not None:
+                    SM[...] = msds[outputs.index(label)]
+            del coords, msds
+        finally:
+            coords_shm.close()
+            coords_shm.unlink()
+            msds_shm.close()
+            msds_shm.unlink()
 
-    geoM2xy = ma.mean(dist, axis=1)
-    gSEM = stat.sem(dist, axis=1)
-    geoM2xy = geoM2xy.data
+    geoM2xy, gSEM = _geometric_stats(moments)
 
     return geoM2xy, gSEM, SM1x, SM1y, SM2xy
+
+
+def MSD_append(folder, name, video, frames, total1, geoM2xy, gSEM, SM1x, SM1y, SM2xy, cut=1,
+               conversion=(1, 1, 1), cache=False, cache_dir=None, max_cache_bytes=None):
+    """
+    Adds the trajectories of one more replicate video to a processed sample
+    without recalculating the MSDs of the trajectories already in it.
+
+    Parameters
+    ----------
+    folder : string
+        Directory containing the trajectory files.
+    name : string
+        Base name of the files, see MSD_iteration.
+    video : integer
+        Number of the new video, i.e. Traj_{name}_{video}.tif.csv is read.
+    frames : integer
+        Total number of frames of the processed sample.  Output from
+        MSD_iteration.
+    total1 : integer
+        Number of particles in the processed sample.  Output from
+        MSD_iteration.
+    geoM2xy, gSEM, SM1x, SM1y, SM2xy : numpy arrays
+        Outputs of vectorized_MMSD_calcs for the processed sample.  SM1x and
+        SM1y can be None if they weren't kept.
+    cut : integer
+        Minimum number of frames for a trajectory to be included.
+    conversion : tuple of floats or integers
+        See MSD_iteration.
+    cache, cache_dir, max_cache_bytes :
+        See MSD_iteration.
+
+    Returns
+    -------
+    total1 : integer
+        Number of particles including the new video.
+    frames : integer
+        Total number of frames including the new video.
+    geoM2xy, gSEM, SM1x, SM1y, SM2xy : numpy arrays
+        As returned by vectorized_MMSD_calcs, with the particles of the new
+        video appended as new columns.  geoM2xy and gSEM are updated from the
+        log MSD statistics of the new particles and of the old ones, which
+        are recovered from geoM2xy, gSEM and the number of nonzero MSDs at
+        each frame.
+
+    Notes
+    -----
+    If the new video has more frames than the processed sample, the MSDs of
+    the old particles at the additional lags are left at 0.  Only particles
+    tracked through the whole of the shorter videos have MSDs at those lags.
+
+    """
+
+    assert type(video) is int, "video must be an integer"
+    assert type(frames) is int, "frames must be an integer"
+    assert type(total1) is int, "total1 must be an integer"
+    assert SM2xy.shape == (frames, total1), "SM2xy must be of dimensions frames x total1"
+
+    traj = load_trajectories(TrajectorySet(folder, name, videos=[video], cache=cache, cache_dir=cache_dir,
+                                           max_cache_bytes=max_cache_bytes), cut=cut, conversion=conversion)
+    newframes = max(frames, traj.n_frames - 1)
+    traj.n_frames = newframes + 1
+    dense_s = traj.to_dense(shifted=True)
+    newgeo, newSEM, newSM1x, newSM1y, newSM2xy = vectorized_MMSD_calcs(newframes, len(traj), dense_s[:, :, 0],
+                                                                       dense_s[:, :, 1])
+
+    # Log MSD statistics of the old particles, without recalculating their logs.
+    count = np.sum(SM2xy > 0, axis=1)
+    M2 = np.where(count > 1, np.nan_to_num(gSEM)**2 * count * (count - 1), 0)
+    moments = (count, np.where(count > 0, geoM2xy, 0), M2)
+    moments = tuple(np.append(moment, np.zeros(newframes - frames)) for moment in moments)
+    geoM2xy, gSEM = _geometric_stats(_merge_moments(moments, _log_moments(newSM2xy)))
+
+    def extend(old, new):
+        if old is None:
+            return None
+        return np.concatenate((np.pad(old, ((0, newframes - frames), (0, 0)), mode='constant'), new), axis=1)
+
+    return (total1 + len(traj), newframes, geoM2xy, gSEM, extend(SM1x, newSM1x), extend(SM1y, newSM1y),
+            extend(SM2xy, newSM2xy))
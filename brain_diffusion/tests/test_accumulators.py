@@ -0,0 +1,128 @@
+import numpy as np
+import numpy.testing as npt
+
+from brain_diffusion.accumulators import EnsembleMSD, VanHove, NonGaussian
+from brain_diffusion.msd import vectorized_MMSD_calcs
+
+
+def test_EnsembleMSD():
+    np.random.seed(5)
+    frames = 20
+    xs_m = np.cumsum(np.random.randn(frames + 1, 9), axis=0) + 50
+    ys_m = np.cumsum(np.random.randn(frames + 1, 9), axis=0) + 50
+    gone = np.random.rand(frames + 1, 9) < 0.2
+    gone[0, :] = False
+    gone[0, 8] = True
+    xs_m[gone] = 0
+    ys_m[gone] = 0
+
+    ensemble = EnsembleMSD()
+    vectorized_MMSD_calcs(frames, 9, xs_m, ys_m, accumulators=[ensemble], chunk_size=4)
+
+    found = ~gone
+    expected = np.zeros(frames)
+    counts = np.zeros(frames)
+    time_expected = np.zeros(frames)
+    time_counts = np.zeros(frames)
+    for lag in range(1, frames):
+        both = found[lag, :] & found[0, :]
+        expected[lag] = np.mean(((xs_m[lag] - xs_m[0])**2 + (ys_m[lag] - ys_m[0])**2)[both])
+        counts[lag] = np.sum(both)
+        pairs = found[lag:, :] & found[:-lag, :]
+        steps = (xs_m[lag:] - xs_m[:-lag])**2 + (ys_m[lag:] - ys_m[:-lag])**2
+        time_expected[lag] = np.mean(steps[pairs])
+        time_counts[lag] = np.sum(pairs)
+
+    npt.assert_equal(np.arange(frames), ensemble.lags)
+    npt.assert_allclose(expected, ensemble.ensemble_msd)
+    npt.assert_equal(counts[1:], ensemble.ensemble_counts[1:])
+    npt.assert_allclose(time_expected, ensemble.time_ensemble_msd)
+    npt.assert_equal(time_counts[1:], ensemble.time_ensemble_counts[1:])
+
+    pooled = EnsembleMSD()
+    vectorized_MMSD_calcs(frames, 9, xs_m, ys_m, accumulators=[pooled], algorithm='fft', n_jobs=2, chunk_size=2)
+    npt.assert_allclose(ensemble.ensemble_msd, pooled.ensemble_msd)
+    npt.assert_allclose(ensemble.time_ensemble_msd, pooled.time_ensemble_msd)
+    npt.assert_equal(ensemble.time_ensemble_counts, pooled.time_ensemble_counts)
+
+
+def test_VanHove():
+    np.random.seed(7)
+    frames = 15
+    xs_m = np.cumsum(np.random.randn(frames + 1, 6), axis=0) + 50
+    ys_m = np.cumsum(np.random.randn(frames + 1, 6), axis=0) + 50
+    gone = np.random.rand(frames + 1, 6) < 0.2
+    xs_m[gone] = 0
+    ys_m[gone] = 0
+    found = ~gone
+
+    edges = np.linspace(-3, 3, 13)
+    pooled = VanHove(edges)
+    adaptive = VanHove(edges, adaptive=True)
+    radial = VanHove(np.linspace(0, 4, 9), radial=True)
+    vectorized_MMSD_calcs(frames, 6, xs_m, ys_m, accumulators=[pooled, adaptive, radial], chunk_size=4,
+                          lags=[0, 1, 4])
+
+    npt.assert_equal(np.zeros(12), pooled.counts[0])
+    for row, lag in ((1, 1), (2, 4)):
+        pairs = found[lag:] & found[:-lag]
+        dx = (xs_m[lag:] - xs_m[:-lag])[pairs]
+        dy = (ys_m[lag:] - ys_m[:-lag])[pairs]
+        steps = np.concatenate((dx, dy))
+        npt.assert_equal(np.histogram(steps, edges)[0], pooled.counts[row])
+        npt.assert_equal(np.histogram(steps, edges*np.sqrt(lag))[0], adaptive.counts[row])
+        assert pooled.outside[row] == steps.shape[0] - np.sum(pooled.counts[row])
+        npt.assert_equal(np.histogram(np.sqrt(dx**2 + dy**2), np.linspace(0, 4, 9))[0], radial.counts[row])
+
+    npt.assert_almost_equal(1 - pooled.outside[1]/(2*np.sum(found[1:] & found[:-1])),
+                            np.sum(pooled.density[1]*np.diff(edges)))
+
+    shared = VanHove(edges, adaptive=True)
+    vectorized_MMSD_calcs(frames, 6, xs_m, ys_m, accumulators=[shared], lags=[0, 1, 4], n_jobs=2, chunk_size=2)
+    npt.assert_equal(adaptive.counts, shared.counts)
+
+    fft = VanHove(np.linspace(0, 4, 9), radial=True)
+    vectorized_MMSD_calcs(frames, 6, xs_m, ys_m, accumulators=[fft], lags=[0, 1, 4], algorithm='fft')
+    npt.assert_equal(radial.counts, fft.counts)
+
+
+def test_NonGaussian():
+    np.random.seed(8)
+    frames = 12
+    xs_m = np.cumsum(np.random.randn(frames + 1, 7), axis=0) + 50
+    ys_m = np.cumsum(np.random.randn(frames + 1, 7), axis=0) + 50
+    gone = np.random.rand(frames + 1, 7) < 0.2
+    xs_m[gone] = 0
+    ys_m[gone] = 0
+    found = ~gone
+
+    nongaussian = NonGaussian(per_track=True)
+    vectorized_MMSD_calcs(frames, 7, xs_m, ys_m, accumulators=[nongaussian], chunk_size=3, max_lag=6)
+    assert nongaussian.track_alpha2.shape == (7, 7)
+    assert np.isnan(nongaussian.alpha2[0])
+    for lag in range(1, 7):
+        pairs = found[lag:] & found[:-lag]
+        squares = (xs_m[lag:] - xs_m[:-lag])**2 + (ys_m[lag:] - ys_m[:-lag])**2
+        r2, r4 = np.mean(squares[pairs]), np.mean(squares[pairs]**2)
+        assert nongaussian.counts[lag] == np.sum(pairs)
+        npt.assert_almost_equal(r2, nongaussian.second_moment[lag])
+        npt.assert_almost_equal(r4 / (2*r2**2) - 1, nongaussian.alpha2[lag])
+        for track in range(7):
+            column = squares[pairs[:, track], track]
+            npt.assert_almost_equal(np.mean(column**2) / (2*np.mean(column)**2) - 1,
+                                    nongaussian.track_alpha2[lag, track])
+
+    shared = NonGaussian(per_track=True)
+    vectorized_MMSD_calcs(frames, 7, xs_m, ys_m, accumulators=[shared], max_lag=6, n_jobs=2, chunk_size=2)
+    npt.assert_allclose(nongaussian.alpha2, shared.alpha2)
+    npt.assert_allclose(nongaussian.track_alpha2, shared.track_alpha2)
+
+    fft = NonGaussian(per_track=True)
+    vectorized_MMSD_calcs(frames, 7, xs_m, ys_m, accumulators=[fft], max_lag=6, algorithm='fft')
+    npt.assert_allclose(nongaussian.track_alpha2, fft.track_alpha2)
+
+    # Gaussian displacements in 3D.
+    coords = np.cumsum(np.random.randn(2001, 50, 3), axis=0) + 50
+    nongaussian = NonGaussian()
+    vectorized_MMSD_calcs(2000, 50, coords, accumulators=[nongaussian], lags=[1, 5], outputs=())
+    npt.assert_allclose(np.zeros(2), nongaussian.alpha2, atol=0.03)
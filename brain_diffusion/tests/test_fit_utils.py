@@ -0,0 +1,43 @@
+import numpy as np
+import numpy.ma as ma
+import numpy.testing as npt
+import scipy.stats as stat
+
+from brain_diffusion.fit_utils import fit_power_law
+
+
+def test_fit_power_law():
+    fps = 100.02
+    t = np.arange(30)/fps
+    SM2xy = 4*np.array([0.5, 2., 0.1])*t[:, np.newaxis]**np.array([0.8, 1.0, 1.2])
+    D, alpha, r2, n = fit_power_law(SM2xy, fps=fps)
+    npt.assert_almost_equal(np.array([0.5, 2., 0.1]), D)
+    npt.assert_almost_equal(np.array([0.8, 1.0, 1.2]), alpha)
+    npt.assert_almost_equal(np.ones(3), r2)
+    npt.assert_equal(np.array([29, 29, 29]), n)
+
+    # Missing entries, a lag window and noise compared with scipy.
+    np.random.seed(6)
+    SM2xy = SM2xy * np.exp(0.1*np.random.randn(*SM2xy.shape))
+    SM2xy[5, 0] = 0
+    SM2xy[7, 1] = np.nan
+    SM2xy[20:, 2] = 0
+    SM2xy = ma.masked_array(SM2xy, mask=np.zeros(SM2xy.shape, dtype=bool))
+    SM2xy[3, 0] = ma.masked
+    D, alpha, r2, n = fit_power_law(SM2xy, fps=fps, lag_window=(2, 25))
+    npt.assert_equal(np.array([22, 23, 18]), n)
+    for i in range(3):
+        rows = np.arange(2, 26)
+        rows = rows[np.isfinite(ma.filled(SM2xy[rows, i], np.nan)) & (ma.filled(SM2xy[rows, i], 0) > 0)]
+        fit = stat.linregress(np.log(rows/fps), np.log(SM2xy.data[rows, i]))
+        npt.assert_almost_equal(fit.slope, alpha[i])
+        npt.assert_almost_equal(np.exp(fit.intercept)/4, D[i])
+        npt.assert_almost_equal(fit.rvalue**2, r2[i])
+
+    # Rows given by lags, per-lag weights and a trajectory too short to fit.
+    lags = np.array([1, 2, 4, 8])
+    SM2xy = np.array([[4., 1.], [8., 0.], [16., 0.], [40., 0.]])
+    D, alpha, r2, n = fit_power_law(SM2xy, lags=lags, fps=1, weights=np.array([1., 1., 1., 0.]))
+    npt.assert_almost_equal(np.array([1., np.nan]), D)
+    npt.assert_almost_equal(np.array([1., np.nan]), alpha)
+    npt.assert_equal(np.array([3, 1]), n)
@@ -9,8 +9,13 @@ import numpy as np
 import numpy.ma as ma
 import numpy.linalg as la
 import numpy.testing as npt
+import pytest
 
-from brain_diffusion.msd import fillin2, MSD_iteration, vectorized_MMSD_calcs
+from brain_diffusion.msd import (fillin2, fillin_tracks, gap_statistics, log_lags, load_trajectories, MSD_iteration, MSD_coordinates,
+                                 vectorized_MMSD_calcs,
+                                 MSD_append)
+from brain_diffusion.trajectory_utils import TrajectorySet, trajectory_cache_size
+from brain_diffusion import msd
 
 
 def test_fillin2():
@@ -38,6 +43,165 @@ def test_fillin2():
     npt.assert_equal(test, fillin2(df))
 
 
+def test_fillin2_methods():
+    np.random.seed(0)
+    for frames in [np.array([3]), np.array([0, 1, 2, 3]), np.array([2, 3, 4, 7, 8, 10]),
+                   np.array([0, 2, 3, 4, 9]), np.cumsum(np.random.randint(1, 4, size=50))]:
+        df = np.zeros((frames.shape[0], 5))
+        df[:, 0] = np.ones(frames.shape[0])
+        df[:, 1] = frames
+        df[:, 2:5] = np.random.rand(frames.shape[0], 3)
+
+        npt.assert_equal(fillin2(df, method='loop'), fillin2(df, method='index'))
+
+
+def test_fillin_tracks():
+    np.random.seed(1)
+    tracks = []
+    for num in range(1, 30):
+        length = np.random.randint(1, 12)
+        frames = np.random.randint(0, 5) + np.cumsum(np.random.choice([1, 1, 1, 2, 4], size=length))
+        track = np.zeros((length, 5))
+        track[:, 0] = num
+        track[:, 1] = frames
+        track[:, 2:5] = np.random.rand(length, 3)
+        tracks.append(track)
+    data = np.concatenate(tracks)
+    counts = np.array([track.shape[0] for track in tracks])
+    starts = np.cumsum(counts) - counts
+
+    # Leave out some tracks, as the cut in MSD_iteration does.
+    keep = counts > 2
+    traj = fillin_tracks(data, starts[keep], counts[keep])
+    assert len(traj) == np.sum(keep)
+    for i, track in enumerate([track for track, kept in zip(tracks, keep) if kept]):
+        filled = fillin2(track, method='loop')
+        assert traj.track_ids[i] == track[0, 0]
+        npt.assert_equal(filled[:, 1], traj[i][0])
+        npt.assert_equal(filled[:, 2:4], traj[i][1])
+
+
+def test_fillin_tracks_gap_strategy():
+    data = np.array([[1, 1, 1, 1, 0],
+                     [1, 2, 2, 2, 0],
+                     [1, 5, 5, 8, 0],
+                     [2, 3, 0, 0, 0],
+                     [2, 4, 1, 1, 0],
+                     [2, 6, 3, 3, 0]], dtype=float)
+    starts = np.array([0, 3])
+    counts = np.array([3, 3])
+
+    n_gaps, longest_gap = gap_statistics(data, starts, counts)
+    npt.assert_equal(np.array([1, 1]), n_gaps)
+    npt.assert_equal(np.array([2, 1]), longest_gap)
+
+    traj = fillin_tracks(data, starts, counts, n_frames=7, gap_strategy='linear')
+    npt.assert_equal(np.array([1, 1]), traj.n_gaps)
+    npt.assert_equal(np.arange(1, 6), traj[0][0])
+    npt.assert_equal(np.array([1., 2., 3., 4., 5.]), traj[0][1][:, 0])
+    npt.assert_equal(np.array([1., 2., 4., 6., 8.]), traj[0][1][:, 1])
+    npt.assert_equal(np.array([0., 1., 2., 3.]), traj[1][1][:, 0])
+
+    traj = fillin_tracks(data, starts, counts, n_frames=7, gap_strategy='missing')
+    npt.assert_equal(np.array([1, 2, 5]), traj[0][0])
+    npt.assert_equal(np.array([[0., 1., 2., 0., 0., 5., 0.],
+                               [0., 0., 0., 0., 1., 0., 3.]]), traj.to_dense()[:, :, 0].T)
+
+    with pytest.raises(AssertionError):
+        fillin_tracks(data, starts, counts, gap_strategy='nearest')
+
+
+def test_load_trajectories(tmpdir):
+    n = 6
+    p = 2
+    df = np.zeros((p*n, 12))
+    for i in range(1, p+1):
+        df[(i-1)*n:i*n, 0] = np.ones(n) + i - 1
+        df[(i-1)*n:i*n, 1] = np.ones(n) + i - 1
+        df[(i-1)*n:i*n, 2] = np.linspace(0, 10, n) + 2 + i
+        df[(i-1)*n:i*n, 3] = np.linspace(0, 10, n) + i
+        df[(i-1)*n:i*n, 4] = np.linspace(0, 10, n) + 3 + i
+    folder = str(tmpdir) + '/'
+    np.savetxt(folder + "Traj_test_data_1.tif.csv", df, delimiter=",")
+    traj = load_trajectories(folder, 'test_data')
+
+    assert len(traj) == p
+    assert traj.n_frames == 15
+    npt.assert_equal(np.array([0, 9, 20]), traj.offsets)
+    npt.assert_equal(np.arange(5, 14), traj[0][0])
+    npt.assert_equal(np.array([3., 3., 5., 5., 7., 7., 9., 9., 11.]), traj[0][1][:, 0])
+    npt.assert_equal(np.array([5., 5., 7., 7., 9., 9., 11., 11., 13., 13., 15.]), traj[1][1][:, 1])
+
+    traj = load_trajectories(folder, 'test_data', cut=5)
+    assert len(traj) == 1
+    npt.assert_equal(np.array([2]), traj.track_ids)
+
+    df[3, 2] = df[2, 2]
+    np.savetxt(folder + "Traj_test_data_1.tif.csv", df, delimiter=",")
+    with pytest.raises(AssertionError):
+        load_trajectories(folder, 'test_data')
+    assert len(load_trajectories(folder, 'test_data', validate=False)) == p
+
+    df = np.array([[0, 1, 1, 0, 0, 0], [1, 1, 2, 0, 0, 0], [2, 1, 6, 0, 0, 0],
+                   [3, 2, 2, 0, 0, 0], [4, 2, 3, 0, 0, 0], [5, 2, 4, 0, 0, 0]], dtype=float)
+    np.savetxt(folder + "Traj_test_data_1.tif.csv", df, delimiter=",")
+    traj = load_trajectories(folder, 'test_data', max_gap=2)
+    npt.assert_equal(np.array([2]), traj.track_ids)
+    npt.assert_equal(np.array([0]), traj.n_gaps)
+
+
+def test_load_trajectories_concurrent(tmpdir):
+    n = 6
+    p = 2
+    for num in range(1, 4):
+        df = np.zeros((p*n, 12))
+        for i in range(1, p+1):
+            df[(i-1)*n:i*n, 1] = np.ones(n) + i - 1
+            df[(i-1)*n:i*n, 2] = np.arange(n) + num
+            df[(i-1)*n:i*n, 3] = np.linspace(0, 10, n) + i + num
+            df[(i-1)*n:i*n, 4] = np.linspace(0, 10, n) + 3 + i
+        np.savetxt(str(tmpdir.join("Traj_test_data_{}.tif.csv".format(num))), df, delimiter=",")
+    folder = str(tmpdir) + '/'
+
+    traj = load_trajectories(folder, 'test_data', totvids=3)
+    assert len(traj) == 6
+    npt.assert_equal(np.arange(1, 7), traj.track_ids)
+    for executor in ('thread', 'process'):
+        traj2 = load_trajectories(folder, 'test_data', totvids=3, n_workers=2, executor=executor)
+        npt.assert_equal(traj.offsets, traj2.offsets)
+        npt.assert_equal(traj.track_ids, traj2.track_ids)
+        npt.assert_equal(traj.frames, traj2.frames)
+        npt.assert_equal(traj.coords, traj2.coords)
+
+    trajset = TrajectorySet(folder, 'test_data', videos=[2, 3])
+    traj3 = load_trajectories(trajset)
+    npt.assert_equal(np.arange(1, 5), traj3.track_ids)
+    npt.assert_equal(traj.coords[traj.offsets[2]:], traj3.coords)
+
+    traj4 = load_trajectories(folder, 'test_data', videos=[2, 3])
+    npt.assert_equal(traj3.coords, traj4.coords)
+
+    # np.loadtxt skips blank lines, so row counts must too.
+    with open(str(tmpdir.join("Traj_test_data_2.tif.csv")), "a") as f:
+        f.write("\n")
+    traj5 = load_trajectories(folder, 'test_data', totvids=3, n_workers=2, executor='thread')
+    npt.assert_equal(traj.coords, traj5.coords)
+
+    # Row counts of cached files are taken from the cache.
+    for executor in ('thread', 'process', 'thread'):
+        traj6 = load_trajectories(folder, 'test_data', totvids=3, n_workers=2, executor=executor, cache=True)
+        npt.assert_equal(traj.coords, traj6.coords)
+
+    cache_dir = str(tmpdir.join('cache'))
+    for n_workers in (1, 2):
+        traj7 = load_trajectories(folder, 'test_data', totvids=3, n_workers=n_workers, cache=True,
+                                  cache_dir=cache_dir, max_cache_bytes=10**6)
+        npt.assert_equal(traj.coords, traj7.coords)
+        assert len([entry for entry in os.listdir(cache_dir) if entry.endswith('.npy')]) == 3
+    MSD_iteration(folder, 'test_data', totvids=3, cache=True, cache_dir=cache_dir, max_cache_bytes=0)
+    assert trajectory_cache_size(cache_dir) == 0
+
+
 def test_MSD_iteration():
     n = 6
     p = 2
@@ -127,6 +291,49 @@ def test_MSD_iteration():
     npt.assert_equal(test4, y_m)
 
 
+def test_MSD_coordinates(tmpdir):
+    n = 6
+    df = np.zeros((2*n, 6))
+    df[:, 0] = np.arange(2*n)
+    df[:, 1] = np.repeat([1, 2], n)
+    df[:, 2] = np.tile(np.arange(1, n + 1), 2)
+    df[:, 3] = np.arange(2*n) + 1
+    df[:, 4] = 2*np.arange(2*n) + 1
+    df[:, 5] = np.tile(np.arange(n)**2, 2) + 1
+    np.savetxt(str(tmpdir.join("Traj_test_data_1.tif.csv")), df, delimiter=",", header="index,id,frame,x,y,z",
+               comments="")
+    folder = str(tmpdir) + '/'
+
+    total1, frames, coords_s, coords = MSD_coordinates(folder, 'test_data', conversion=(1, 1, 0.5), ndim=3)
+    assert coords_s.shape == (frames + 1, 2, 3)
+    # As fillin2, filled in tracks lag one row behind in runs of consecutive frames.
+    npt.assert_equal(np.array([1., 1., 2., 5., 10., 17.])/2, coords_s[:n, 0, 2])
+    total1, frames, xs_m, ys_m, x_m, y_m = MSD_iteration(folder, 'test_data')
+    npt.assert_equal(xs_m, coords_s[:, :, 0])
+    npt.assert_equal(ys_m, coords_s[:, :, 1])
+
+    planar = vectorized_MMSD_calcs(frames, total1, xs_m, ys_m)
+    for algorithm in ('direct', 'fft'):
+        outputs = vectorized_MMSD_calcs(frames, total1, coords_s, algorithm=algorithm)
+        npt.assert_allclose(planar[2], outputs[2], rtol=1e-9)
+        npt.assert_allclose(planar[3], outputs[3], rtol=1e-9)
+        z = coords_s[:n, 0, 2]
+        npt.assert_allclose(planar[4][1:n, 0] + [np.mean((z[lag:] - z[:-lag])**2) for lag in range(1, n)],
+                            outputs[4][1:n, 0], rtol=1e-9)
+
+    # Positions are found along all axes at once, so z = 0 is a real coordinate.
+    coords = np.zeros((11, 1, 3))
+    coords[:, 0, 0] = np.arange(1, 12)
+    coords[:, 0, 1] = 5
+    coords[1::2, 0, 2] = 1
+    for options in ({}, {'algorithm': 'fft'}, {'outputs': ('SM2xy',)}):
+        outputs = vectorized_MMSD_calcs(10, 1, coords, **options)
+        npt.assert_allclose(outputs[4][1:4, 0], [2, 4, 10], rtol=1e-9)
+    coords[3, 0, :] = 0
+    outputs = vectorized_MMSD_calcs(10, 1, coords, max_lag=1)
+    npt.assert_allclose(outputs[4][1, 0], 2, rtol=1e-9)
+
+
 def test_vectorized_MMSD_calcs():
     n = 6
     p = 2
@@ -149,7 +356,8 @@ def test_vectorized_MMSD_calcs():
                       3.95124372, 4.27666612, 4.60517019, 4.85203026, 5.09986643,
                       5.29831737,  0.,  0.,  0.])
 
-    test2 = np.array([0., 0., 0., 0., 0., 0.,  0.,  0.,  0.,  2.54993321, 2.64915868, 0., 0., 0.])
+    # Standard errors are undefined where fewer than two particles have an MSD.
+    test2 = np.array([np.nan, 0., 0., 0., 0., 0.,  0.,  0.,  0.,  np.nan, np.nan, np.nan, np.nan, np.nan])
 
     test3 = np.array([[0.,    0.],
                       [2.,    2.],
@@ -171,3 +379,167 @@ def test_vectorized_MMSD_calcs():
     npt.assert_equal(test3, SM1x)
     npt.assert_equal(test3, SM1y)
     npt.assert_equal(2*test3, SM2xy)
+
+    total1, frames, xs_m, ys_m, x_m, y_m = MSD_iteration(folder, name, dtype=np.float32)
+    assert xs_m.dtype == np.float32
+    outputs = vectorized_MMSD_calcs(frames, total1, xs_m, ys_m, dtype=np.float32)
+    assert outputs[4].dtype == np.float32
+    assert outputs[0].dtype == np.float64
+    npt.assert_allclose(2*test3, outputs[4], rtol=1e-6)
+    npt.assert_almost_equal(test1, outputs[0])
+    outputs = vectorized_MMSD_calcs(frames, total1, xs_m, ys_m, dtype=np.float32, n_jobs=2)
+    npt.assert_allclose(2*test3, outputs[4], rtol=1e-6)
+
+    # With NaN padding, real coordinates of 0 are kept.
+    total1, frames, xs_m, ys_m, x_m, y_m = MSD_iteration(folder, name, fill_value=np.nan)
+    xs_m = xs_m - xs_m[0, :]
+    outputs = vectorized_MMSD_calcs(frames, total1, xs_m, ys_m, missing=np.nan)
+    npt.assert_equal(test3, outputs[2])
+    npt.assert_equal(2*test3, outputs[4])
+    npt.assert_almost_equal(test1, outputs[0])
+
+
+def test_vectorized_MMSD_calcs_fft():
+    np.random.seed(2)
+    frames = 40
+    xs_m = np.cumsum(np.random.randn(frames + 1, 12), axis=0) + 50
+    ys_m = np.cumsum(np.random.randn(frames + 1, 12), axis=0) + 50
+    gone = np.random.rand(frames + 1, 12) < 0.3
+    xs_m[gone] = 0
+    ys_m[gone] = 0
+    xs_m[:, 0] = 0
+    xs_m[5:10, 1] = 20
+
+    direct = vectorized_MMSD_calcs(frames, 12, xs_m, ys_m)
+    fft = vectorized_MMSD_calcs(frames, 12, xs_m, ys_m, algorithm='fft')
+    for expected, actual in zip(direct, fft):
+        npt.assert_allclose(expected, actual, rtol=1e-9, atol=1e-12)
+    npt.assert_equal(direct[4] > 0, fft[4] > 0)
+
+    with pytest.raises(AssertionError):
+        vectorized_MMSD_calcs(frames, 12, xs_m, ys_m, algorithm='loop')
+
+
+def test_vectorized_MMSD_calcs_lags():
+    np.random.seed(3)
+    frames = 30
+    xs_m = np.cumsum(np.random.randn(frames + 1, 8), axis=0) + 50
+    ys_m = np.cumsum(np.random.randn(frames + 1, 8), axis=0) + 50
+    xs_m[np.random.rand(frames + 1, 8) < 0.2] = 0
+    full = vectorized_MMSD_calcs(frames, 8, xs_m, ys_m)
+
+    lags = log_lags(frames - 1, 6)
+    npt.assert_equal(np.array([1, 2, 4, 8, 15, 29]), lags)
+    for algorithm in ('direct', 'fft'):
+        outputs = vectorized_MMSD_calcs(frames, 8, xs_m, ys_m, algorithm=algorithm, lags=lags)
+        assert outputs[4].shape == (6, 8)
+        for expected, actual in zip(full, outputs):
+            npt.assert_allclose(expected[lags], actual, rtol=1e-9, atol=1e-12)
+
+        outputs = vectorized_MMSD_calcs(frames, 8, xs_m, ys_m, algorithm=algorithm, max_lag=5)
+        assert outputs[4].shape == (6, 8)
+        for expected, actual in zip(full, outputs):
+            npt.assert_allclose(expected[:6], actual, rtol=1e-9, atol=1e-12)
+
+    with pytest.raises(AssertionError):
+        vectorized_MMSD_calcs(frames, 8, xs_m, ys_m, lags=[1, frames])
+
+
+def test_vectorized_MMSD_calcs_chunks():
+    np.random.seed(4)
+    frames = 25
+    xs_m = np.cumsum(np.random.randn(frames + 1, 11), axis=0) + 50
+    ys_m = np.cumsum(np.random.randn(frames + 1, 11), axis=0) + 50
+    xs_m[np.random.rand(frames + 1, 11) < 0.2] = 0
+    full = vectorized_MMSD_calcs(frames, 11, xs_m, ys_m)
+
+    for options in ({'chunk_size': 3}, {'memory_limit': 8*16*(frames + 1)*2, 'algorithm': 'fft'}):
+        outputs = vectorized_MMSD_calcs(frames, 11, xs_m, ys_m, **options)
+        for expected, actual in zip(full, outputs):
+            npt.assert_allclose(expected, actual, rtol=1e-9, atol=1e-12)
+
+    outputs = vectorized_MMSD_calcs(frames, 11, xs_m, ys_m, n_jobs=2, chunk_size=4)
+    for expected, actual in zip(full, outputs):
+        npt.assert_allclose(expected, actual, rtol=1e-12, atol=1e-12)
+
+    outputs = vectorized_MMSD_calcs(frames, 11, xs_m, ys_m, outputs=('SM2xy',), chunk_size=4)
+    assert outputs[2] is None and outputs[3] is None
+    npt.assert_allclose(full[4], outputs[4], rtol=1e-12)
+    npt.assert_allclose(full[0], outputs[0], rtol=1e-12)
+    outputs = vectorized_MMSD_calcs(frames, 11, xs_m, ys_m, outputs=('SM1y',), n_jobs=2)
+    assert outputs[2] is None and outputs[4] is None
+    npt.assert_allclose(full[3], outputs[3], rtol=1e-12)
+    npt.assert_allclose(full[1], outputs[1], rtol=1e-12)
+
+    assert msd._chunk_columns(11, frames + 1, 'direct', memory_limit=8*4*(frames + 1)*5) == 5
+    assert msd._chunk_columns(10**6, frames + 1, 'direct') == msd.CHUNK_BYTES // (8*4*(frames + 1))
+    with pytest.raises(AssertionError):
+        vectorized_MMSD_calcs(frames, 11, xs_m, ys_m, chunk_size=0)
+
+    outputs = vectorized_MMSD_calcs(5, 0, np.zeros((6, 0)), np.zeros((6, 0)), n_jobs=2)
+    assert outputs[4].shape == (5, 0)
+
+
+def test_vectorized_MMSD_calcs_out_dir(tmpdir, monkeypatch):
+    n = 6
+    p = 3
+    df = np.zeros((p*n, 12))
+    for i in range(1, p+1):
+        df[(i-1)*n:i*n, 1] = np.ones(n) + i - 1
+        df[(i-1)*n:i*n, 2] = np.arange(n) + i
+        df[(i-1)*n:i*n, 3] = np.linspace(0, 10, n)**2 + i
+        df[(i-1)*n:i*n, 4] = np.linspace(0, 10, n) + 3 + i
+    folder = str(tmpdir.mkdir('trajectories')) + '/'
+    np.savetxt(folder + "Traj_test_data_1.tif.csv", df, delimiter=",")
+    out_dir = str(tmpdir)
+
+    total1, frames, xs_m, ys_m, x_m, y_m = MSD_iteration(folder, 'test_data')
+    geoM2xy, gSEM, SM1x, SM1y, SM2xy = vectorized_MMSD_calcs(frames, total1, xs_m, ys_m)
+
+    # Force several column blocks.
+    monkeypatch.setattr(msd, 'MMAP_BLOCK_BYTES', 8*frames)
+    total1, frames, xs_mm, ys_mm, x_mm, y_mm = MSD_iteration(folder, 'test_data', out_dir=out_dir)
+    npt.assert_equal(xs_m, xs_mm)
+    npt.assert_equal(y_m, y_mm)
+    assert os.path.isfile(os.path.join(out_dir, 'xys_test_data.npy'))
+
+    outputs = vectorized_MMSD_calcs(frames, total1, xs_mm, ys_mm, out_dir=out_dir, name='test_data')
+    assert isinstance(outputs[4], np.memmap)
+    npt.assert_almost_equal(geoM2xy, outputs[0])
+    npt.assert_almost_equal(gSEM, outputs[1])
+    npt.assert_almost_equal(SM1x, outputs[2])
+    npt.assert_almost_equal(SM1y, outputs[3])
+    npt.assert_almost_equal(SM2xy, np.load(os.path.join(out_dir, 'SM2xy_test_data.npy')))
+
+    with pytest.raises(AssertionError):
+        vectorized_MMSD_calcs(frames, total1, xs_mm, ys_mm, out_dir=out_dir, name='test_data', n_jobs=2)
+
+
+def test_MSD_append(tmpdir):
+    n = 8
+    p = 3
+    for num in range(1, 3):
+        df = np.zeros((p*n, 12))
+        for i in range(1, p+1):
+            df[(i-1)*n:i*n, 1] = np.ones(n) + i - 1
+            df[(i-1)*n:i*n, 2] = np.arange(n) + i + 2*num
+            df[(i-1)*n:i*n, 3] = np.linspace(0, 10, n)**2 + i + num
+            df[(i-1)*n:i*n, 4] = np.linspace(0, 10, n)*i + num
+        np.savetxt(str(tmpdir.join("Traj_test_data_{}.tif.csv".format(num))), df, delimiter=",")
+    folder = str(tmpdir) + '/'
+
+    total1, frames, xs_m, ys_m, x_m, y_m = MSD_iteration(folder, 'test_data', totvids=2)
+    expected = vectorized_MMSD_calcs(frames, total1, xs_m, ys_m)
+
+    total1, frames, xs_m, ys_m, x_m, y_m = MSD_iteration(folder, 'test_data', totvids=1)
+    outputs = vectorized_MMSD_calcs(frames, total1, xs_m, ys_m)
+    appended = MSD_append(folder, 'test_data', 2, frames, total1, *outputs)
+
+    assert appended[0] == 2*p
+    assert appended[1] == expected[0].shape[0]
+    for test, result in zip(expected, appended[2:]):
+        npt.assert_almost_equal(test, result)
+
+    appended = MSD_append(folder, 'test_data', 2, frames, total1, outputs[0], outputs[1], None, None, outputs[4])
+    assert appended[4] is None
+    npt.assert_almost_equal(expected[4], appended[6])
@@ -0,0 +1,191 @@
+import os
+import numpy as np
+import numpy.testing as npt
+
+from brain_diffusion.trajectory_utils import (csv_to_array, read_trajectory, CACHE_DIRNAME, trajectory_cache_size,
+                                              prune_trajectory_cache, trajectory_file_info, group_tracks,
+                                              RaggedTrajectories, TrajectorySet, index_trajectory_files,
+                                              validate_trajectories)
+
+
+def test_csv_to_array(tmpdir):
+    df = np.arange(12.).reshape((3, 4))
+    filename = str(tmpdir.join('sample_file.csv'))
+    np.savetxt(filename, df, delimiter=',')
+
+    npt.assert_equal(df, csv_to_array(filename))
+    npt.assert_equal(df[1:, 1:3], csv_to_array(filename, skiprows=1, usecols=(1, 2)))
+    assert csv_to_array(filename, dtype=np.float32).dtype == np.float32
+
+
+def test_read_trajectory(tmpdir):
+    n = 6
+    df = np.zeros((n, 12))
+    df[:, 0] = np.arange(n)
+    df[:, 1] = np.ones(n)
+    df[:, 2] = np.linspace(0, 10, n)
+    df[:, 3] = np.linspace(0, 10, n) + 1
+    df[:, 4] = np.linspace(0, 10, n) + 2
+    df[:, 5] = np.linspace(0, 10, n) + 3
+    df[:, 6:12] = np.ones((n, 6))
+    filename = str(tmpdir.join('Traj_test_data_1.tif.csv'))
+    np.savetxt(filename, df, delimiter=',')
+
+    data = read_trajectory(filename)
+    npt.assert_equal(df[1:, 1:6], data)
+    assert data.dtype == np.float64
+
+    data = read_trajectory(filename, dtype=np.float32)
+    npt.assert_equal(df[1:, 1:6].astype(np.float32), data)
+    assert data.dtype == np.float32
+
+
+def test_read_trajectory_cache(tmpdir):
+    n = 6
+    df = np.zeros((n, 12))
+    df[:, 1] = np.ones(n)
+    df[:, 2] = np.arange(n)
+    df[:, 3] = np.linspace(0, 10, n)
+    filename = str(tmpdir.join('Traj_test_data_1.tif.csv'))
+    np.savetxt(filename, df, delimiter=',')
+    cache_dir = str(tmpdir.join(CACHE_DIRNAME))
+
+    first = read_trajectory(filename, cache=True)
+    assert trajectory_cache_size(cache_dir) > 0
+    second = read_trajectory(filename, cache=True, verify_hash=True)
+    assert isinstance(second, np.memmap)
+    npt.assert_equal(first, second)
+
+    # Changing the source file invalidates the cached entry.
+    df[:, 3] = 2*df[:, 3]
+    np.savetxt(filename, df, delimiter=',', fmt='%.6f')
+    third = read_trajectory(filename, cache=True)
+    npt.assert_equal(df[1:, 1:6], third)
+    assert not isinstance(third, np.memmap)
+
+    assert len(prune_trajectory_cache(cache_dir, 0)) == 1
+    assert trajectory_cache_size(cache_dir) == 0
+
+
+def test_RaggedTrajectories():
+    frames = [np.array([2, 3, 4]), np.array([0, 1])]
+    coords = [np.array([[1., 2.], [3., 4.], [5., 6.]]), np.array([[7., 8.], [9., 10.]])]
+    traj = RaggedTrajectories.from_tracks(frames, coords, n_frames=6)
+
+    assert len(traj) == 2
+    assert traj.ndim == 2
+    npt.assert_equal(np.array([0, 3, 5]), traj.offsets)
+    npt.assert_equal(np.array([1, 2]), traj.track_ids)
+    assert traj.n_gaps is None and traj.longest_gap is None
+    npt.assert_equal(frames[1], traj[1][0])
+    npt.assert_equal(coords[1], traj[1][1])
+
+    dense = traj.to_dense()
+    assert dense.shape == (6, 2, 2)
+    npt.assert_equal(np.array([0., 0., 1., 3., 5., 0.]), dense[:, 0, 0])
+    npt.assert_equal(np.array([8., 10., 0., 0., 0., 0.]), dense[:, 1, 1])
+
+    dense_s = traj.to_dense(shifted=True, fill_value=np.nan)
+    npt.assert_equal(np.array([2., 4., 6., np.nan, np.nan, np.nan]), dense_s[:, 0, 1])
+    npt.assert_equal(np.array([7., 9., np.nan, np.nan, np.nan, np.nan]), dense_s[:, 1, 0])
+
+
+def test_group_tracks():
+    order, ids, starts, counts = group_tracks(np.array([1., 1., 2., 3., 3., 3.]))
+    assert order == slice(None)
+    npt.assert_equal(np.array([1., 2., 3.]), ids)
+    npt.assert_equal(np.array([0, 2, 3]), starts)
+    npt.assert_equal(np.array([2, 1, 3]), counts)
+
+    track_ids = np.array([2, 1, 2, 3, 1, 1])
+    order, ids, starts, counts = group_tracks(track_ids)
+    npt.assert_equal(np.array([1, 4, 5, 0, 2, 3]), order)
+    npt.assert_equal(np.array([1, 2, 3]), ids)
+    npt.assert_equal(np.array([0, 3, 5]), starts)
+    npt.assert_equal(np.array([3, 2, 1]), counts)
+
+
+def test_trajectory_file_info(tmpdir):
+    df = np.zeros((7, 12))
+    df[:, 1] = np.array([1, 1, 1, 2, 2, 3, 3])
+    filename = str(tmpdir.join('Traj_test_data_1.tif.csv'))
+    np.savetxt(filename, df, delimiter=',')
+
+    assert trajectory_file_info(filename) == (6, 3)
+    assert trajectory_file_info(filename, blocksize=5) == (6, 3)
+
+    with open(filename, 'a') as f:
+        f.write('\n\n')
+    assert trajectory_file_info(filename) == (6, 3)
+    with open(filename, 'a') as f:
+        f.write('# comment\n\n0,4,1,0,0,0,0,0,0,0,0,0')
+    for blocksize in (1, 7, 2**20):
+        assert trajectory_file_info(filename, blocksize=blocksize) == (7, 4)
+
+    cache_dir = str(tmpdir.join('cache'))
+    read_trajectory(filename, cache=True, cache_dir=cache_dir)
+    assert trajectory_file_info(filename, cache=True, cache_dir=cache_dir) == (7, 4)
+
+
+def test_TrajectorySet(tmpdir):
+    n = 4
+    for num in range(1, 4):
+        df = np.zeros((2*n, 12))
+        df[:, 1] = np.repeat([1, 2], n)
+        df[:, 2] = np.tile(np.arange(n), 2) + num
+        df[:, 3] = np.arange(2*n) + 10*num
+        np.savetxt(str(tmpdir.join('Traj_test_data_{}.tif.csv'.format(num))), df, delimiter=',')
+
+    trajset = TrajectorySet(str(tmpdir), 'test_data', totvids=3)
+    assert len(trajset) == 3
+    npt.assert_equal(np.array([2, 2, 2]), trajset.particle_counts)
+    npt.assert_equal(np.array([0, 2, 4]), trajset.particle_offsets)
+    assert trajset.n_particles == 6
+    assert trajset.frame_range(2) == (2, 5)
+    assert trajset.frame_range() == (1, 6)
+
+    data = trajset.video(3)
+    npt.assert_equal(np.array([5, 5, 5, 6, 6, 6, 6]), data[:, 0])
+    npt.assert_equal(np.arange(31, 38), data[:, 2])
+
+    tracks = list(trajset.subset([2, 3]).iter_tracks())
+    assert [track_id for track_id, rows in tracks] == [1, 2, 3, 4]
+    assert [rows.shape[0] for track_id, rows in tracks] == [3, 4, 3, 4]
+    assert [num for num, data in trajset.subset([3])] == [3]
+
+
+def test_index_trajectory_files(tmpdir):
+    for filename in ['Traj_RED_S1_1.tif.csv', 'Traj_RED_S1_3.tif.csv', 'Traj_RED_S2_12.tif.csv',
+                     'SM2xy_RED_S1.csv', 'notes.txt']:
+        tmpdir.join(filename).write('')
+    folder = str(tmpdir)
+
+    index = index_trajectory_files(folder)
+    assert sorted(index) == ['RED_S1', 'RED_S2']
+    assert sorted(index['RED_S1']) == [1, 3]
+    assert index['RED_S2'][12] == os.path.join(folder, 'Traj_RED_S2_12.tif.csv')
+
+    index = index_trajectory_files(folder, pattern='^SM2xy_(?P<name>.+)[.]csv$')
+    assert index == {'RED_S1': {None: os.path.join(folder, 'SM2xy_RED_S1.csv')}}
+
+
+def test_validate_trajectories():
+    data = np.zeros((8, 5))
+    data[:, 0] = np.array([1, 1, 1, 2, 2, 3, 3, 3])
+    data[:, 1] = np.array([0, 1, 2, 5, 6, 1, 3, 4])
+    report = validate_trajectories(data)
+    assert report['valid']
+    assert report['rows'] == 8
+    assert report['errors'] == []
+
+    data[1, 3] = np.nan
+    data[4, 1] = 4
+    data[7, 1] = 1
+    report = validate_trajectories(data)
+    assert not report['valid']
+    assert len(report['errors']) == 3
+    npt.assert_equal(np.array([1]), report['nonfinite'])
+    npt.assert_equal(np.array([4, 7]), report['unordered'])
+    npt.assert_equal(np.array([7]), report['duplicates'])
+
+    assert not validate_trajectories(np.zeros((3, 4)))['valid']
@@ -0,0 +1,867 @@
+import os
+import re
+import json
+import hashlib
+import numpy as np
+
+# Columns of a MOSAIC trajectory csv file that are used in the analysis, in
+# order Track ID, frames, x coordinates, y coordinates, and z coordinates.  The
+# first column of the file is a row index and is skipped.
+TRAJ_COLUMNS = (1, 2, 3, 4, 5)
+
+# Default filename pattern of trajectory files, Traj_{name}_{video}.tif.csv.
+TRAJ_PATTERN = r'^Traj_(?P<name>.+)_(?P<video>\d+)\.tif\.csv$'
+
+# Name of the directory created next to the input files to hold cached binary
+# copies of parsed trajectory files.
+CACHE_DIRNAME = '.traj_cache'
+
+
+def csv_to_array(filename, skiprows=0, usecols=None, dtype=np.float64):
+    """
+    Reads a comma delimited file of numbers into a two-dimensional numpy array.
+
+    Parameters
+    ----------
+    filename : string
+        Name of the csv file to be read.
+    skiprows : integer
+        Number of lines at the top of the file to skip (e.g. a header row).
+    usecols : tuple of integers or None
+        Columns to be parsed.  Columns that aren't listed are never converted.
+        If None, all columns are parsed.
+    dtype : numpy dtype
+        Data type of the output array.
+
+    Returns
+    -------
+    data : numpy array of dimensions rows x columns
+        Contents of the csv file.  Always two-dimensional, even for files
+        containing a single row.
+
+    Examples
+    --------
+    >>> np.savetxt('sample_file.csv', np.ones((3, 4)), delimiter=',')
+    >>> csv_to_array('sample_file.csv', usecols=(0, 1))
+    array([[ 1.,  1.],
+           [ 1.,  1.],
+           [ 1.,  1.]])
+
+    """
+
+    assert type(filename) is str, "filename must be a string"
+    assert type(skiprows) is int, "skiprows must be an integer"
+
+    return np.loadtxt(filename, delimiter=',', skiprows=skiprows, usecols=usecols, dtype=dtype, ndmin=2)
+
+
+def index_trajectory_files(folder, pattern=TRAJ_PATTERN):
+    """
+    Finds all trajectory files in a folder with a single directory scan.
+
+    Parameters
+    ----------
+    folder : string
+        Directory to be scanned.
+    pattern : string
+        Regular expression matched against each filename.  Must contain a
+        named group 'name' for the sample name and may contain a named group
+        'video' for the video number.  The default matches
+        Traj_{name}_{video}.tif.csv.
+
+    Returns
+    -------
+    index : dictionary
+        Maps each sample name to a dictionary from video number (None if the
+        pattern has no video group) to the full filename.  Video numbers don't
+        need to start at 1 or be contiguous.
+
+    Examples
+    --------
+    >>> index = index_trajectory_files('./')
+    >>> sorted(index['RED_nPEG_37C_72pH_S1_1'])
+    [1, 2, 3]
+    >>> sm_index = index_trajectory_files('./', pattern='^SM2xy_(?P<name>.+)[.]csv$')
+
+    """
+
+    assert type(folder) is str, "folder must be a string"
+    assert os.path.isdir(folder), "folder must be an existing directory"
+
+    regex = re.compile(pattern)
+    assert 'name' in regex.groupindex, "pattern must contain a group named 'name'"
+
+    index = dict()
+    for entry in os.scandir(folder):
+        match = regex.match(entry.name)
+        if match is None:
+            continue
+        video = match.group('video') if 'video' in regex.groupindex else None
+        if video is not None:
+            video = int(video)
+        index.setdefault(match.group('name'), dict())[video] = os.path.join(folder, entry.name)
+
+    return index
+
+
+def file_hash(filename, blocksize=2**20):
+    """
+    Calculates a content hash of a file without loading it into memory at once.
+
+    Parameters
+    ----------
+    filename : string
+        Name of the file to be hashed.
+    blocksize : integer
+        Number of bytes read at a time.
+
+    Returns
+    -------
+    digest : string
+        Hexadecimal blake2b digest of the file contents.
+
+    """
+
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def trajectory_cache_dir(filename, cache_dir=None):
+    """
+    Returns the directory holding the cached entry of filename, i.e. cache_dir
+    or by default the .traj_cache folder next to filename.
+    """
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(filename)), CACHE_DIRNAME)
+    return cache_dir
+
+
+def _cache_paths(filename, dtype, cache_dir):
+    """
+    Returns the cached array and metadata filenames belonging to filename.
+    """
+
+    cache_dir = trajectory_cache_dir(filename, cache_dir)
+    base = os.path.join(cache_dir, '{}.{}'.format(os.path.basename(filename), np.dtype(dtype).name))
+    return base + '.npy', base + '.json'
+
+
+def _load_cached(filename, dtype, cache_dir, verify_hash):
+    """
+    Loads a cached trajectory array if it is still valid, otherwise returns None.
+    """
+
+    npyname, metaname = _cache_paths(filename, dtype, cache_dir)
+    if not (os.path.isfile(npyname) and os.path.isfile(metaname)):
+        return None
+
+    with open(metaname) as f:
+        meta = json.load(f)
+    stat = os.stat(filename)
+    if meta['size'] != stat.st_size or meta['mtime_ns'] != stat.st_mtime_ns:
+        return None
+    if verify_hash and meta['hash'] != file_hash(filename):
+        return None
+
+    # Touch the cached array so that pruning evicts least recently used entries.
+    os.utime(npyname)
+    try:
+        return np.load(npyname, mmap_mode='r')
+    except ValueError:
+        # Zero-length arrays can't be memory-mapped.
+        return np.load(npyname)
+
+
+def _save_cached(filename, data, cache_dir):
+    """
+    Writes data and the size, mtime and content hash of filename to the cache.
+    """
+
+    npyname, metaname = _cache_paths(filename, data.dtype, cache_dir)
+    stat = os.stat(filename)
+    meta = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': file_hash(filename)}
+
+    try:
+        os.makedirs(os.path.dirname(npyname), exist_ok=True)
+        # Write to temporary files first so that readers never see partial entries.
+        with open(npyname + '.tmp', 'wb') as f:
+            np.save(f, data)
+        with open(metaname + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(npyname + '.tmp', npyname)
+        os.replace(metaname + '.tmp', metaname)
+    except OSError:
+        # Caching is an optimization only, e.g. the input folder may be read-only.
+        pass
+
+
+def trajectory_cache_size(cache_dir):
+    """
+    Returns the total size in bytes of the cached arrays in cache_dir.
+    """
+
+    if not os.path.isdir(cache_dir):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.name.endswith('.npy'))
+
+
+def prune_trajectory_cache(cache_dir, max_bytes):
+    """
+    Evicts least recently used entries from a trajectory cache.
+
+    Parameters
+    ----------
+    cache_dir : string
+        Cache directory, by default the .traj_cache folder next to the input
+        trajectory files.
+    max_bytes : integer
+        Maximum total size of the cached arrays.  Entries are removed, least
+        recently used first, until the cache is no larger than max_bytes.
+
+    Returns
+    -------
+    removed : list of strings
+        Names of the cached arrays that were removed.
+
+    """
+
+    assert type(max_bytes) is int, "max_bytes must be an integer"
+
+    if not os.path.isdir(cache_dir):
+        return []
+
+    entries = sorted((entry for entry in os.scandir(cache_dir) if entry.name.endswith('.npy')),
+                     key=lambda entry: entry.stat().st_mtime_ns)
+    total = sum(entry.stat().st_size for entry in entries)
+
+    removed = []
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        total = total - entry.stat().st_size
+        os.remove(entry.path)
+        metaname = entry.path[:-len('.npy')] + '.json'
+        if os.path.isfile(metaname):
+            os.remove(metaname)
+        removed.append(entry.path)
+
+    return removed
+
+
+def clear_trajectory_cache(cache_dir):
+    """
+    Removes every entry from a trajectory cache.
+    """
+
+    return prune_trajectory_cache(cache_dir, 0)
+
+
+def read_trajectory(filename, dtype=np.float64, cache=False, cache_dir=None, verify_hash=False,
+                    max_cache_bytes=None):
+    """
+    Reads a MOSAIC trajectory csv file, parsing only the columns used in MSD
+    calculations.
+
+    Parameters
+    ----------
+    filename : string
+        Name of the trajectory file, of the form Traj_{}_{}.tif.csv.  The
+        first row of the file is treated as a header and the first column as a
+        row index; both are skipped.
+    dtype : numpy dtype
+        Data type of the output array, e.g. np.float32 or np.float64.
+    cache : boolean
+        If True, the parsed array is stored as a .npy file in cache_dir and
+        later calls load it memory-mapped instead of parsing the csv file.  A
+        cached entry is discarded when the size or modification time of the
+        csv file changes.
+    cache_dir : string or None
+        Directory holding cached arrays.  Defaults to a .traj_cache folder next
+        to filename.
+    verify_hash : boolean
+        If True, also compares the content hash of the csv file with the hash
+        stored in the cache before using a cached entry.
+    max_cache_bytes : integer or None
+        If given, least recently used entries are evicted after writing a new
+        entry until the cache is no larger than max_cache_bytes.
+
+    Returns
+    -------
+    data : numpy array of dimensions rows x 5
+        Contains in order Track ID, frames, x coordinates, y coordinates, and z
+        coordinates, in the units of the input file.  Read-only and
+        memory-mapped if loaded from the cache.
+
+    Examples
+    --------
+    >>> df = np.zeros((4, 12))
+    >>> df[:, 1] = 1
+    >>> df[:, 2] = np.arange(4)
+    >>> np.savetxt("Traj_test_data_1.tif.csv", df, delimiter=",")
+    >>> read_trajectory("Traj_test_data_1.tif.csv")
+    array([[ 1.,  1.,  0.,  0.,  0.],
+           [ 1.,  2.,  0.,  0.,  0.],
+           [ 1.,  3.,  0.,  0.,  0.]])
+
+    """
+
+    assert type(filename) is str, "filename must be a string"
+    assert os.path.isfile(filename), "filename must exist"
+
+    if cache:
+        data = _load_cached(filename, dtype, cache_dir, verify_hash)
+        if data is not None:
+            return data
+
+    data = csv_to_array(filename, skiprows=1, usecols=TRAJ_COLUMNS, dtype=dtype)
+
+    if cache:
+        _save_cached(filename, data, cache_dir)
+        if max_cache_bytes is not None:
+            prune_trajectory_cache(trajectory_cache_dir(filename, cache_dir), max_cache_bytes)
+
+    return data
+
+
+# A newline followed by a line that np.loadtxt skips, blank or a comment.
+_SKIPPED_LINE = re.compile(rb'\n[ \t\r\f\v]*(?=[\n#])')
+
+# Bytes present in a block of a file if it may contain such lines, other than
+# empty lines, which are found from adjacent newlines.
+_SKIPPED_MARKERS = (b'#', b' ', b'\t', b'\r', b'\f', b'\v')
+
+
+def trajectory_file_info(filename, blocksize=2**20, cache=False, cache_dir=None, dtype=np.float64):
+    """
+    Finds the number of rows and the last Track ID of a trajectory file without
+    parsing it.
+
+    Parameters
+    ----------
+    filename : string
+        Name of the trajectory file, of the form Traj_{}_{}.tif.csv.
+    blocksize : integer
+        Number of bytes read at a time.
+    cache : boolean
+        If True and read_trajectory has a valid cached entry of filename, the
+        rows and last Track ID are taken from the cached array instead.
+    cache_dir : string or None
+        Cache directory, see read_trajectory.
+    dtype : numpy dtype
+        Data type of the cached entry, see read_trajectory.
+
+    Returns
+    -------
+    rows : integer
+        Number of rows that read_trajectory returns, i.e. lines excluding the
+        header row, blank lines and comments.
+    last_id : integer
+        Track ID of the last row, which is the number of tracks in a MOSAIC
+        trajectory file.
+
+    """
+
+    assert type(filename) is str, "filename must be a string"
+    assert os.path.isfile(filename), "filename must exist"
+
+    if cache:
+        data = _load_cached(filename, dtype, cache_dir, False)
+        if data is not None:
+            return data.shape[0], int(data[-1, 0]) if data.shape[0] > 0 else 0
+
+    rows = 0
+    with open(filename, 'rb') as f:
+        f.readline()
+        # Each block starts at the newline ending the previous complete line.
+        carry = b'\n'
+        for block in iter(lambda: f.read(blocksize), b''):
+            block = carry + block
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+            end = newlines[-1]
+            rows = rows + newlines.shape[0] - 1
+            if np.any(np.diff(newlines) == 1) or any(marker in block for marker in _SKIPPED_MARKERS):
+                rows = rows - len(_SKIPPED_LINE.findall(block, 0, end + 1))
+            carry = block[end:]
+        lastline = carry.strip()
+        if lastline and not lastline.startswith(b'#'):
+            rows = rows + 1
+
+        # Read backwards from the end of the file until a full line is found.
+        size = f.seek(0, os.SEEK_END)
+        tail = b''
+        while size > 0 and tail.strip().count(b'\n') < 1:
+            step = min(size, 4096)
+            size = size - step
+            f.seek(size)
+            tail = f.read(step) + tail
+        lastline = tail.strip().split(b'\n')[-1]
+
+    last_id = int(float(lastline.split(b',')[TRAJ_COLUMNS[0]])) if rows > 0 else 0
+
+    return rows, last_id
+
+
+def group_tracks(track_ids):
+    """
+    Finds the rows belonging to each track of a trajectory dataset in a single
+    pass.
+
+    Parameters
+    ----------
+    track_ids : numpy array
+        Track ID of each row, e.g. the first column of the output of
+        read_trajectory.  Rows of the same track don't need to be adjacent.
+
+    Returns
+    -------
+    order : numpy array of integers or slice
+        Index that sorts the rows by Track ID, keeping the original order
+        within each track.  A slice selecting every row if track_ids is
+        already sorted, so that indexing with it doesn't copy.
+    ids : numpy array
+        Unique Track IDs in ascending order.
+    starts : numpy array of integers
+        Index of the first row of each track in the sorted rows.
+    counts : numpy array of integers
+        Number of rows of each track.
+
+    Examples
+    --------
+    >>> order, ids, starts, counts = group_tracks(np.array([2, 1, 2, 1, 1]))
+    >>> order
+    array([1, 3, 4, 0, 2])
+    >>> ids, starts, counts
+    (array([1, 2]), array([0, 3]), array([3, 2]))
+
+    """
+
+    track_ids = np.asarray(track_ids)
+    assert track_ids.ndim == 1, "track_ids must be one-dimensional"
+
+    if track_ids.shape[0] == 0 or np.all(track_ids[1:] >= track_ids[:-1]):
+        order = slice(None)
+        sorted_ids = track_ids
+    else:
+        order = np.argsort(track_ids, kind='stable')
+        sorted_ids = track_ids[order]
+
+    boundary = np.empty(sorted_ids.shape[0], dtype=bool)
+    boundary[:1] = True
+    np.not_equal(sorted_ids[1:], sorted_ids[:-1], out=boundary[1:])
+    starts = np.flatnonzero(boundary)
+    counts = np.diff(np.append(starts, sorted_ids.shape[0]))
+
+    return order, sorted_ids[starts], starts, counts
+
+
+def validate_trajectories(data):
+    """
+    Checks a trajectory dataset in a single vectorized pass over all rows.
+
+    Parameters
+    ----------
+    data : numpy array
+        Trajectory dataset as returned by read_trajectory, possibly the
+        concatenation of several videos.  Must have 5 columns containing in
+        order Track ID, frames, x coordinates, y coordinates, and z
+        coordinates.
+
+    Returns
+    -------
+    report : dictionary
+        Contains 'valid' (True if no problem was found), 'rows' (number of
+        rows checked), 'errors' (list of descriptions of each problem) and
+        arrays of the row indices failing each check: 'nonfinite' (rows
+        containing nan or inf), 'unordered' (rows whose frame is lower than
+        the frame of the previous row of the same track) and 'duplicates'
+        (rows repeating the Track ID and frame of an earlier row).
+
+    Examples
+    --------
+    >>> data = np.array([[1, 0, 1., 1., 0], [1, 2, 1., 1., 0], [1, 1, 1., np.nan, 0]])
+    >>> report = validate_trajectories(data)
+    >>> report['valid'], report['nonfinite'], report['unordered']
+    (False, array([2]), array([2]))
+
+    """
+
+    empty = np.zeros(0, dtype=np.int64)
+    report = dict(valid=False, rows=0, errors=[], nonfinite=empty, unordered=empty, duplicates=empty)
+
+    if not isinstance(data, np.ndarray) or data.ndim != 2 or data.shape[1] != 5:
+        report['errors'].append('Input must be a numpy array with five columns.')
+        return report
+    report['rows'] = data.shape[0]
+    if data.shape[0] == 0:
+        report['errors'].append('Input must not be empty.')
+        return report
+
+    report['nonfinite'] = np.flatnonzero(~np.all(np.isfinite(data), axis=1))
+
+    # Frames must increase from row to row within each track.
+    order, ids, starts, counts = group_tracks(data[:, 0])
+    rows = np.arange(data.shape[0])[order]
+    frames = data[order, 1]
+    same_track = np.ones(data.shape[0] - 1, dtype=bool)
+    same_track[starts[1:] - 1] = False
+    report['unordered'] = np.sort(rows[1:][same_track & (frames[1:] < frames[:-1])])
+
+    # (Track ID, frame) pairs must be unique, even if not in adjacent rows.
+    pairs = np.lexsort((np.arange(data.shape[0]), data[:, 1], data[:, 0]))
+    repeated = (data[pairs[1:], 0] == data[pairs[:-1], 0]) & (data[pairs[1:], 1] == data[pairs[:-1], 1])
+    report['duplicates'] = np.sort(pairs[1:][repeated])
+
+    for key, description in [('nonfinite', 'contain non-finite values'),
+                             ('unordered', 'have frames lower than the previous row of the same track'),
+                             ('duplicates', 'repeat the Track ID and frame of an earlier row')]:
+        if report[key].shape[0] > 0:
+            report['errors'].append('{} rows {} (first at row {}).'.format(report[key].shape[0], description,
+                                                                          report[key][0]))
+    report['valid'] = len(report['errors']) == 0
+
+    return report
+
+
+class RaggedTrajectories(object):
+    """
+    Container for trajectories of different lengths stored as flat arrays.
+
+    Observations of all tracks are stored back to back, similar to a
+    compressed sparse row matrix: the rows of track i are
+    frames[offsets[i]:offsets[i+1]] and coords[offsets[i]:offsets[i+1]].
+    Memory therefore grows with the number of observations rather than with
+    frames x particles.
+
+    Parameters
+    ----------
+    frames : numpy array of integers
+        Frame of each observation.  Must be sorted within each track.
+    coords : numpy array of dimensions observations x ndim
+        Coordinates of each observation.
+    offsets : numpy array of integers
+        Start index of each track in frames and coords, followed by the total
+        number of observations.
+    track_ids : numpy array or None
+        Track ID of each track.  Defaults to 1, 2, ..., number of tracks.
+    n_frames : integer or None
+        Number of frames in the video, i.e. rows of the dense view.  Defaults
+        to the largest frame + 1.
+    n_gaps : numpy array of integers or None
+        Number of gaps in each track before it was filled in, see
+        msd.gap_statistics.  None if unknown.
+    longest_gap : numpy array of integers or None
+        Longest gap of each track, in frames, see msd.gap_statistics.  None
+        if unknown.
+
+    Examples
+    --------
+    >>> traj = RaggedTrajectories.from_tracks([np.array([2, 3])], [np.array([[1., 1.], [2., 2.]])])
+    >>> len(traj)
+    1
+    >>> traj.to_dense(shifted=True)[:, :, 0]
+    array([[ 1.],
+           [ 2.],
+           [ 0.],
+           [ 0.]])
+
+    """
+
+    def __init__(self, frames, coords, offsets, track_ids=None, n_frames=None, n_gaps=None, longest_gap=None):
+        frames = np.asarray(frames, dtype=np.int64)
+        coords = np.asarray(coords)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if coords.ndim == 1:
+            coords = coords[:, np.newaxis]
+
+        assert frames.shape[0] == coords.shape[0], "frames and coords must have the same number of rows"
+        assert offsets[0] == 0 and offsets[-1] == frames.shape[0], "offsets must span all observations"
+        assert np.all(np.diff(offsets) >= 0), "offsets must not decrease"
+
+        self.frames = frames
+        self.coords = coords
+        self.offsets = offsets
+        if track_ids is None:
+            track_ids = np.arange(1, offsets.shape[0])
+        self.track_ids = np.asarray(track_ids)
+        if n_frames is None:
+            n_frames = int(frames.max()) + 1 if frames.shape[0] > 0 else 0
+        self.n_frames = n_frames
+        self.n_gaps = n_gaps
+        self.longest_gap = longest_gap
+
+    @classmethod
+    def from_tracks(cls, frames, coords, track_ids=None, n_frames=None, n_gaps=None, longest_gap=None):
+        """
+        Builds a RaggedTrajectories object from lists of per-track arrays.
+        """
+
+        lengths = [track.shape[0] for track in frames]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        if len(lengths) == 0:
+            return cls(np.zeros(0), np.zeros((0, 2)), offsets, track_ids, n_frames, n_gaps, longest_gap)
+        return cls(np.concatenate(frames), np.concatenate(coords), offsets, track_ids, n_frames, n_gaps, longest_gap)
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, i):
+        start, stop = self.offsets[i], self.offsets[i+1]
+        return self.frames[start:stop], self.coords[start:stop]
+
+    @property
+    def ndim(self):
+        return self.coords.shape[1]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def first_frames(self):
+        return self.frames[self.offsets[:-1][self.lengths > 0]]
+
+    def to_dense(self, shifted=False, fill_value=0, dtype=None, out=None):
+        """
+        Scatters the trajectories into a dense frames x particles x ndim array.
+
+        Parameters
+        ----------
+        shifted : boolean
+            If True, trajectories are shifted such that they all begin at frame
+            0.
+        fill_value : float
+            Value of entries where a particle isn't present in a frame.
+        dtype : numpy dtype or None
+            Data type of the output.  Defaults to the dtype of coords.
+        out : numpy array or None
+            Preallocated output array of dimensions n_frames x tracks x ndim,
+            e.g. a numpy.memmap.
+
+        Returns
+        -------
+        dense : numpy array of dimensions n_frames x tracks x ndim
+            Coordinates of every track in its own column.
+
+        """
+
+        if dtype is None:
+            dtype = self.coords.dtype
+        shape = (self.n_frames, len(self), self.ndim)
+        if out is None:
+            out = np.full(shape, fill_value, dtype=dtype)
+        else:
+            assert out.shape == shape, "out must have dimensions n_frames x tracks x ndim"
+            out[...] = fill_value
+
+        lengths = self.lengths
+        cols = np.repeat(np.arange(len(self)), lengths)
+        rows = self.frames
+        if shifted:
+            rows = rows - np.repeat(self.first_frames, lengths[lengths > 0])
+        out[rows, cols, :] = self.coords
+
+        return out
+
+
+class TrajectorySet(object):
+    """
+    Lazily opened collection of the trajectory files of one sample.
+
+    Nothing is parsed when the set is created.  Particle counts come from
+    trajectory_file_info, frame ranges from parsing only the frame column, and
+    coordinates are read only when a video is accessed.  A TrajectorySet can
+    be passed to msd.MSD_iteration and msd.load_trajectories in place of
+    folder to analyze all or part of a sample.
+
+    Parameters
+    ----------
+    folder : string
+        Directory containing the trajectory files.
+    name : string
+        Sample name, as parsed from the filenames by pattern.
+    totvids : integer or None
+        Number of videos, numbered from 1.  Ignored if videos is given.  If
+        both are None, every video of the sample found in folder is used.
+    videos : list of integers or None
+        Video numbers to include in the set.
+    dtype : numpy dtype
+        Data type of the arrays returned by video.
+    cache : boolean
+        If True, videos are read through the binary cache of read_trajectory.
+    cache_dir : string or None
+        Cache directory, see read_trajectory.
+    max_cache_bytes : integer or None
+        Size limit of the cache, see read_trajectory.
+    pattern : string
+        Filename pattern, see index_trajectory_files.
+    index : dictionary or None
+        Output of index_trajectory_files for folder, so that several sets can
+        share a single directory scan.  If None, folder is scanned.
+
+    Examples
+    --------
+    >>> trajset = TrajectorySet('./', 'test_data', totvids=3)
+    >>> len(trajset), trajset.n_particles
+    (3, 42)
+    >>> for num, data in trajset.subset([2, 3]):
+            print(num, data.shape)
+
+    """
+
+    def __init__(self, folder, name, totvids=None, videos=None, dtype=np.float64, cache=False, pattern=TRAJ_PATTERN,
+                 index=None, cache_dir=None, max_cache_bytes=None):
+        assert type(folder) is str, "folder must be a string"
+        assert type(name) is str, "name must be a string"
+
+        if index is None:
+            index = index_trajectory_files(folder, pattern)
+        assert name in index, "folder must contain trajectory files of {}".format(name)
+        if videos is None and totvids is None:
+            videos = sorted(index[name])
+        elif videos is None:
+            assert type(totvids) is int, "totvids must be an integer"
+            videos = range(1, totvids + 1)
+
+        self.folder = folder
+        self.name = name
+        self.videos = [int(num) for num in videos]
+        self.dtype = dtype
+        self.cache = cache
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.pattern = pattern
+        for num in self.videos:
+            assert num in index[name], "folder must contain video {} of {}".format(num, name)
+        self.filenames = [index[name][num] for num in self.videos]
+        self._index = dict([(name, dict((num, index[name][num]) for num in self.videos))])
+
+        self._info = dict()
+        self._frame_ranges = dict()
+
+    def __len__(self):
+        return len(self.videos)
+
+    def __iter__(self):
+        return self.iter_videos()
+
+    def _position(self, num):
+        assert num in self.videos, "video {} is not part of the set".format(num)
+        return self.videos.index(num)
+
+    def filename(self, num):
+        """
+        Returns the trajectory filename of video num.
+        """
+
+        return self.filenames[self._position(num)]
+
+    def info(self, num):
+        """
+        Returns the number of rows and the number of particles of video num,
+        see trajectory_file_info.
+        """
+
+        if num not in self._info:
+            self._info[num] = trajectory_file_info(self.filename(num), cache=self.cache, cache_dir=self.cache_dir,
+                                                   dtype=self.dtype)
+        return self._info[num]
+
+    @property
+    def particle_counts(self):
+        """
+        Number of particles in each video, in the order of videos.
+        """
+
+        return np.array([self.info(num)[1] for num in self.videos], dtype=np.int64)
+
+    @property
+    def particle_offsets(self):
+        """
+        Number added to the Track IDs of each video to make them unique in the
+        set, i.e. the total number of particles in the videos before it.
+        """
+
+        return np.append(0, np.cumsum(self.particle_counts)[:-1])
+
+    @property
+    def n_particles(self):
+        return int(np.sum(self.particle_counts))
+
+    def frame_range(self, num=None):
+        """
+        Returns the first and last frame of video num, or of the whole set if
+        num is None.  Only the frame column is parsed.
+        """
+
+        if num is None:
+            ranges = np.array([self.frame_range(video) for video in self.videos])
+            return int(ranges[:, 0].min()), int(ranges[:, 1].max())
+
+        if num not in self._frame_ranges:
+            frames = csv_to_array(self.filename(num), skiprows=1, usecols=(TRAJ_COLUMNS[1],))
+            self._frame_ranges[num] = (int(frames.min()), int(frames.max()))
+        return self._frame_ranges[num]
+
+    def video(self, num, offset_ids=True):
+        """
+        Reads video num.
+
+        Parameters
+        ----------
+        num : integer
+            Video number.
+        offset_ids : boolean
+            If True, Track IDs are offset by particle_offsets so that they are
+            unique across the set, as in msd.MSD_iteration.
+
+        Returns
+        -------
+        data : numpy array of dimensions rows x 5
+            Contains Track ID, frames, x, y and z coordinates, see
+            read_trajectory.
+
+        """
+
+        data = read_trajectory(self.filename(num), dtype=self.dtype, cache=self.cache, cache_dir=self.cache_dir,
+                               max_cache_bytes=self.max_cache_bytes)
+        if offset_ids:
+            data = np.array(data)
+            data[:, 0] = data[:, 0] + self.particle_offsets[self._position(num)]
+        return data
+
+    def iter_videos(self):
+        """
+        Yields the video number and data of each video, reading one at a time.
+        """
+
+        for num in self.videos:
+            yield num, self.video(num)
+
+    def iter_tracks(self):
+        """
+        Yields the Track ID and rows of every track in the set, reading one
+        video at a time.
+        """
+
+        for num, data in self.iter_videos():
+            order, ids, starts, counts = group_tracks(data[:, 0])
+            data = data[order]
+            for track_id, start, count in zip(ids, starts, counts):
+                yield int(track_id), data[start:start+count]
+
+    def subset(self, videos):
+        """
+        Returns a new TrajectorySet containing only the given video numbers.
+        """
+
+        trajset = TrajectorySet(self.folder, self.name, videos=videos, dtype=self.dtype, cache=self.cache,
+                                pattern=self.pattern, index=self._index)
+        trajset._info = dict((num, self._info[num]) for num in trajset.videos if num in self._info)
+        trajset._frame_ranges = dict((num, self._frame_ranges[num]) for num in trajset.videos
+                                     if num in self._frame_ranges)
+        return trajset
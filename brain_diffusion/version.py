@@ -70,3 +70,5 @@ MINOR = _version_minor
 MICRO = _version_micro
 VERSION = __version__
 REQUIRES = ["numpy", "scipy", "matplotlib"]
+# multiprocessing.shared_memory, used by msd with n_workers and n_jobs.
+PYTHON_REQUIRES = ">=3.8"
@@ -22,6 +22,7 @@ opts = dict(name=NAME,
             platforms=PLATFORMS,
             version=VERSION,
             install_requires=REQUIRES,
+            python_requires=PYTHON_REQUIRES,
             requires=REQUIRES)
 
 